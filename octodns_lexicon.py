@@ -3,12 +3,52 @@
 #
 
 
+import atexit
+import cProfile
+import hashlib
+import importlib
+import json
 import logging
+import os
+import pstats
+import random
 import shlex
+import sqlite3
+import sys
 import re
-from threading import Lock
-
-from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from itertools import count
+from threading import Event, Lock, Thread, current_thread, local
+from time import sleep, time
+
+from collections import Counter, OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # pragma: no cover
+    from urlparse import urlsplit
+
+try:
+    from http.cookiejar import DefaultCookiePolicy
+except ImportError:  # pragma: no cover
+    from cookielib import DefaultCookiePolicy
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+try:
+    from time import perf_counter
+except ImportError:  # pragma: no cover
+    from time import time as perf_counter
 
 from lexicon.client import Client as LexiconClient
 from lexicon.config import ConfigResolver as LexiconConfigResolver, \
@@ -16,9 +56,178 @@ from lexicon.config import ConfigResolver as LexiconConfigResolver, \
 
 from octodns.provider.base import BaseProvider
 from octodns.record import Record
+from octodns.zone import Zone
 
 __version__ = "0.1.dev4"
 
+try:
+    intern = sys.intern
+except AttributeError:  # pragma: no cover
+    # python 2, where the builtin intern only takes str, but octodns names
+    # and types are unicode, which are then left as they are
+    def intern(string, _intern=intern):
+        return _intern(string) if isinstance(string, str) else string
+
+
+# Content which str.split splits just like shlex.split does: printable ascii
+# and spaces only, without quotes or escapes
+_PLAIN_CONTENT = re.compile(r'[ !#-&(-\[\]-~]*\Z')
+# The pieces of a token, and the whitespace between tokens, as shlex.split
+# lexes them: words, double quoted strings (in which backslashes escape
+# only quotes and backslashes), single quoted strings, and escapes
+_CONTENT_PIECE = re.compile(
+    r"""([^ \t\r\n'"\\]+)|"((?:[^"\\]|\\.)*)"|'([^']*)'|\\(.)|([ \t\r\n]+)""",
+    re.S)
+_QUOTED_ESCAPE = re.compile(r'\\(["\\])')
+
+
+def split_content(content):
+    """
+    Splits a lexicon content into its fields, such as the priority and
+    exchange of MX values, exactly like shlex.split but much faster
+    """
+    if _PLAIN_CONTENT.match(content):
+        return content.split()
+
+    tokens = []
+    token = None
+    pos = 0
+    while pos < len(content):
+        match = _CONTENT_PIECE.match(content, pos)
+        if match is None:
+            # An unterminated quote or escape, shlex raises for it
+            return shlex.split(content)
+        pos = match.end()
+
+        word, double_quoted, single_quoted, escaped, space = match.groups()
+        if space is not None:
+            if token is not None:
+                tokens.append(token)
+                token = None
+            continue
+
+        if word is not None:
+            piece = word
+        elif double_quoted is not None:
+            piece = _QUOTED_ESCAPE.sub(r'\1', double_quoted)
+        elif single_quoted is not None:
+            piece = single_quoted
+        else:
+            piece = escaped
+        token = piece if token is None else token + piece
+
+    if token is not None:
+        tokens.append(token)
+    return tokens
+
+
+def _name_and_type(lexicon_record):
+    return lexicon_record['name'], lexicon_record['type']
+
+
+class ValuesCodec:
+    """
+    Values which are lexicon contents as they are, e.g. A or NS. Codecs may
+    normalize the contents of the lexicon records they parse, the ids of the
+    values are remembered by the normalized contents.
+    """
+
+    def parse(self, lexicon_records):
+        return {'values': [r['content'] for r in lexicon_records]}
+
+    def format(self, octodns_record):
+        return octodns_record.values
+
+
+class TxtCodec(ValuesCodec):
+    """
+    TXT values, which octodns has with ; escaped and lexicon has as they
+    are. A DNS character string holds at most 255 characters, so longer
+    values are listed and written in quoted chunks of 255 characters, with
+    quotes escaped, and joined into one octodns value.
+    """
+    CHUNK_SIZE = 255
+
+    def parse(self, lexicon_records):
+        values = []
+        for record in lexicon_records:
+            content = record['content']
+            if len(content) > 1 and content[0] == '"' and content[-1] == '"':
+                content = \
+                    content[1:-1].replace('" "', '').replace('\\"', '"')
+                # Remembered as format writes it, for its id to be found
+                record['content'] = self._chunked(content)
+            values.append(content.replace(';', '\\;'))
+        return {'values': values}
+
+    def format(self, octodns_record):
+        return [self._chunked(value.replace('\\;', ';'))
+                for value in octodns_record.values]
+
+    def _chunked(self, content):
+        if len(content) <= self.CHUNK_SIZE:
+            return content
+        return '"{}"'.format('" "'.join(
+            content[i:i + self.CHUNK_SIZE].replace('"', '\\"')
+            for i in range(0, len(content), self.CHUNK_SIZE)))
+
+
+class ValueCodec:
+    """A single value which is a lexicon content as it is, e.g. CNAME"""
+
+    def parse(self, lexicon_records):
+        return {'value': lexicon_records[0]['content']}
+
+    def format(self, octodns_record):
+        return octodns_record.value,
+
+
+class FieldsCodec:
+    """
+    Values of several fields, which lexicon has as one content of their
+    space separated (and possibly quoted) fields, e.g. MX or SRV
+    """
+
+    def __init__(self, fields, template):
+        self.fields = fields
+        # Formats a value of the octodns record, e.g. '{0.port}'
+        self._format_value = template.format
+
+    def parse(self, lexicon_records):
+        values = []
+        for record in lexicon_records:
+            fields = split_content(record['content'])
+            if len(fields) != len(self.fields):
+                raise ValueError('expected {} fields in "{}"'.format(
+                    len(self.fields), record['content']))
+            values.append(dict(zip(self.fields, fields)))
+        return {'values': values}
+
+    def format(self, octodns_record):
+        return [self._format_value(value) for value in octodns_record.values]
+
+
+# How the values of each record type are parsed from lexicon contents, and
+# formatted as lexicon contents, by record type
+RECORD_CODECS = {
+    'A': ValuesCodec(),
+    'AAAA': ValuesCodec(),
+    'ALIAS': ValueCodec(),
+    'CAA': FieldsCodec(('flags', 'tag', 'value'),
+                       '{0.flags} {0.tag} "{0.value}"'),
+    'CNAME': ValueCodec(),
+    'MX': FieldsCodec(('priority', 'exchange'),
+                      '{0.preference} {0.exchange}'),
+    'NS': ValuesCodec(),
+    'PTR': ValueCodec(),
+    'SRV': FieldsCodec(('priority', 'weight', 'port', 'target'),
+                       '{0.priority} {0.weight} {0.port} {0.target}'),
+    'SSHFP': FieldsCodec(('algorithm', 'fingerprint_type', 'fingerprint'),
+                         '{0.algorithm} {0.fingerprint_type} '
+                         '{0.fingerprint}'),
+    'TXT': TxtCodec(),
+}
+
 
 class LexiconProvider(BaseProvider):
     """
@@ -29,10 +238,112 @@ class LexiconProvider(BaseProvider):
 
         supports: list of record types to support (A, AAAA, CNAME ...)
                 intersects with:
-                    LexiconProvider.IMPLEMENTED
+                    LexiconProvider.IMPLEMENTED | LexiconProvider.OPT_IN
+                (default: LexiconProvider.IMPLEMENTED)
 
         lexicon_config: lexicon config
 
+        apply_max_workers: if larger than 1, changes for different record
+                names are applied concurrently on this many worker threads.
+                Changes to the same name are still applied in order.
+                (default: 1, apply serially)
+
+        client_max_age: number of seconds an authenticated lexicon client
+                is reused for the same zone, across populate and apply.
+                Set to 0 to authenticate anew for every operation.
+                (default: 300)
+
+        http_pool_size: if set, HTTP requests made by the wrapped lexicon
+                provider go through one pooled requests session per API
+                host, keeping up to this many connections open per host.
+                (default: unset, one connection per request)
+
+        http_keep_alive: whether pooled connections are kept alive between
+                requests. Only used together with http_pool_size.
+                (default: True)
+
+        listing_cache: if set, the raw listing of each zone is cached on
+                disk and reused by populate. _apply always lists anew.
+                directory: where to keep the cached listings (required)
+                max_age: seconds a cached listing is fresh (default: 60)
+                stale_while_revalidate: serve a cached listing past its
+                        max_age, while refreshing it in the background
+                        (default: False)
+
+        rate_limit: if set, all calls to the wrapped lexicon provider are
+                rate limited, and retried with backoff when throttled.
+                rate: calls per second (default: 10)
+                burst: calls that may be made at once (default: rate)
+                max_retries: retries of a throttled call (default: 5)
+                backoff: seconds to back off after the first throttled
+                        attempt, doubled for every attempt after that.
+                        (default: 1)
+                max_backoff: upper limit of the backoff (default: 60)
+
+        rrset_update: if True, and the wrapped lexicon provider can replace
+                all values of a name and type at once, every change is
+                applied with a single such call rather than one call per
+                value. Supported for lexicon providers which implement
+                replace_rrset(rtype, name, contents) and for powerdns.
+                (default: False)
+
+        memoize_listings: if True, the listings many lexicon providers make
+                themselves for every record they create, update or delete
+                (e.g. to find the identifier of the record to delete) are
+                served during _apply from one snapshot of the zone, which
+                is kept up to date with the changes made. (default: False)
+
+        id_index: if set, the lexicon identifiers of the values listed by
+                populate are persisted, so that _apply can run in another
+                process than populate without listing the zone again. They
+                are only used if the existing records of the plan are the
+                ones they were listed with, the zone is listed anew if not.
+                directory: where to keep the index (required)
+
+        remembered_ids: limits of the lexicon ids kept in memory, for long
+                running processes populating many zones. The ids of the
+                zones used least recently are forgotten beyond them, and
+                _apply lists such zones anew.
+                max_zones: number of zones (default: unlimited)
+                max_bytes: approximate size of the ids (default: unlimited)
+
+        streaming_populate: if True, populate sorts the listing of a zone by
+                name and type, and builds the records of the zone from it
+                one at a time, freeing the listed values of each as it goes.
+                Takes less memory for very large zones. (default: False)
+
+        metrics_hook: a callable, or the dotted path of one, which is called
+                with a summary of the time spent in each phase (creating the
+                client, authenticating, listing, building records, and each
+                create/update/delete call) at the end of every populate and
+                _apply. The summary is logged either way. (default: unset)
+
+        api_metrics: if set, every call made to the wrapped lexicon provider
+                is counted and timed, labelled by provider id, zone,
+                operation and outcome, along with the number of records of
+                every listing. The metrics are exported in the OpenMetrics
+                text format to a file, rewritten at the end of every
+                populate and _apply, and/or served for scraping. Providers
+                configured alike share one set of metrics.
+                file: path of the file to write the metrics to
+                port: local port to serve the metrics on, at /metrics
+                host: address to serve the metrics on (default: 127.0.0.1)
+
+        profile: if set, every populate and _apply is profiled, writing one
+                profile per zone and operation to a directory, and the top
+                hotspots across all of them are logged at exit. Without it,
+                populate and _apply are not wrapped at all.
+                directory: where to write the profiles (required)
+                mode: deterministic profiles with cProfile and writes
+                        pstats files. Only one operation is profiled at a
+                        time, operations running meanwhile still run, but
+                        unprofiled. sampling samples the stack of the
+                        profiled thread every interval and writes
+                        collapsed stacks, e.g. for flamegraph.pl.
+                        (default: deterministic)
+                interval: seconds between samples (default: 0.005)
+                top: number of hotspots to log (default: 20)
+
     Configuration added to the lexicon_config block will be injected as a
     lexicon DictConfigSource. Further config sources read are the env config
     source.
@@ -61,110 +372,249 @@ class LexiconProvider(BaseProvider):
                 auth_token: "better kept in environment variable"
 
     """
-    IMPLEMENTED = {
-        'A', 'AAAA', 'ALIAS', 'CAA', 'CNAME', 'MX', 'NS', 'SRV', 'TXT'}
+    # Types supported unless supports says otherwise. Types registered in
+    # RECORD_CODECS since are only supported when listed in supports, so
+    # that existing configs don't start planning to delete their records.
+    OPT_IN = {'PTR', 'SSHFP'}
+    IMPLEMENTED = set(RECORD_CODECS) - OPT_IN
 
     SUPPORTS_GEO = False
     SUPPORTS_DYNAMIC = False
 
-    def __init__(self, id, lexicon_config, supports=None, **kwargs):
+    def __init__(self, id, lexicon_config, supports=None,
+                 apply_max_workers=1, client_max_age=300,
+                 http_pool_size=None, http_keep_alive=True,
+                 listing_cache=None, rate_limit=None, rrset_update=False,
+                 memoize_listings=False, id_index=None,
+                 remembered_ids=None, streaming_populate=False,
+                 metrics_hook=None, api_metrics=None, profile=None,
+                 **kwargs):
 
         self.log = logging.getLogger('LexiconProvider[{}]'.format(id))
 
-        self.SUPPORTS = self.IMPLEMENTED.intersection(
+        self.SUPPORTS = (self.IMPLEMENTED | self.OPT_IN).intersection(
             {s.upper() for s in supports}) if supports else self.IMPLEMENTED
 
+        # How the values of each supported type are parsed and formatted
+        self._codecs = {_type: RECORD_CODECS[_type] for _type in self.SUPPORTS}
+
         super(LexiconProvider, self).__init__(id, **kwargs)
 
         self.log.info('__init__: id=%s, token=***, account=%s', id, kwargs)
 
-        self.remembered_ids = RememberedIds()
+        self.remembered_ids = RememberedIds(**(remembered_ids or {}))
         self.lexicon_config = lexicon_config
+        self.apply_max_workers = apply_max_workers or 1
+        self.clients = LexiconClientPool(self._create_client, client_max_age)
+        self.http_sessions = HttpSessionPool(http_pool_size, http_keep_alive) \
+            if http_pool_size else None
+        self.listing_cache = ZoneListingCache(id, **listing_cache) \
+            if listing_cache else None
+        self._populated_from_cache = set()
+        self.rate_limiter = RateLimiter(**rate_limit) \
+            if rate_limit else None
+        self.rrset_update = rrset_update
+        self.memoize_listings = memoize_listings
+        self.id_index = ZoneIdIndex(id, **id_index) if id_index else None
+        self.streaming_populate = streaming_populate
+        self.metrics_hook = _resolve_callable(metrics_hook) \
+            if metrics_hook else None
+        self.api_metrics = ApiMetrics.shared(**api_metrics) \
+            if api_metrics else None
+        self.apply_stats = Counter()
+        self._stats_lock = Lock()
+
+        self.profiler = None
+        if profile:
+            self.profiler = ZoneProfiler(id, **profile)
+            self._profile_operations()
+
+    def _profile_operations(self):
+        # Overridden on the instance, so that populate and _apply only go
+        # through the profiler when profiling is configured
+        populate, apply = self.populate, self._apply
+
+        def profiled_populate(zone, *args, **kwargs):
+            return self.profiler.profile('populate', zone.name, populate,
+                                         zone, *args, **kwargs)
+
+        def profiled_apply(plan):
+            return self.profiler.profile('_apply', plan.existing.name, apply,
+                                         plan)
+
+        self.populate = profiled_populate
+        self._apply = profiled_apply
 
     def populate(self, zone, target=False, lenient=False):
 
-        loaded_types = defaultdict(lambda: defaultdict(list))
         before = len(zone.records)
-        lexicon_client, _ = self._create_client(zone_name=zone.name[:-1])
-        exists = False
+        timings = PhaseTimings()
 
-        lexicon_client.provider.authenticate()
-        for lexicon_record in lexicon_client.provider.list_records(
-                None, None, None):
+        try:
+            listing = self._list_zone(zone.name, timings)
             # No way of knowing for sure whether a zone exists or not,
             # But if it has contents, it is safe to assume that it does.
-            exists = True
-            self.log.debug("provider listed {!s}".format(lexicon_record))
+            exists = len(listing) > 0
 
-            # harmonize record values here
-            if lexicon_record['type'] in ['CNAME', 'MX', 'NS']:
-                if not lexicon_record['content'][-1] == '.':
-                    domain_part = shlex.split(lexicon_record['content'])[-1]
-                    if '.' in domain_part:
-                        lexicon_record['content'] += '.'
-                    else:
-                        lexicon_record['content'] += ".{}".format(zone.name)
+            loaded = self._load_records(zone, listing, lenient, timings)
+            if self.id_index is not None:
+                self.id_index.store(zone.name, loaded)
+        finally:
+            self._report_timings('populate', zone.name, timings)
+            if self.api_metrics is not None:
+                self.api_metrics.write()
 
-                    self.log.info("Harmonizing [%s] -> [%s]",
-                                  domain_part, lexicon_record['content'])
-
-            loaded_types[lexicon_record["name"]][lexicon_record["type"]] \
-                .append(lexicon_record)
-
-        for record_by_name, data_by_id in loaded_types.items():
-            for record_type, lexicon_records in data_by_id.items():
-                self.log.debug("Got {!s} from above".format(lexicon_records))
-
-                if record_type in self.SUPPORTS:
-
-                    _data_func = getattr(self,
-                                         '_data_for_{}'.format(record_type))
-
-                    data = _data_func(record_type, lexicon_records)
+        self.log.info('populate:   found %s records, exists=%s',
+                      len(zone.records) - before, before < len(zone.records))
 
-                    self.log.debug('populate: adding record {} records: {!s}'
-                                   .format(record_by_name, data))
+        return exists
 
-                    if record_by_name.endswith(zone.name):
-                        # This should be handled in the various
-                        # Lexicon providers.
-                        #  However, there is no harm in doing some extra
-                        #  check for it here  - just in case.
-                        record_by_name = record_by_name.rstrip('.')
+    def _list_zone(self, zone_name, timings, fresh=False):
+        def list_records():
+            # Only created (and authenticated) when the listing is not
+            # served from the cache, which then takes no network round trip
+            lexicon_client, _ = self.clients.get(zone_name[:-1], timings)
+            started = perf_counter()
+            listing = list(lexicon_client.provider.list_records(
+                None, None, None))
+            timings.lap('list_records', started)
+            return listing
+
+        if self.listing_cache is None:
+            return list_records()
+
+        if fresh:
+            self._populated_from_cache.discard(zone_name)
+            return self.listing_cache.refresh(zone_name, list_records)
+
+        listing, cached = self.listing_cache.get(zone_name, list_records)
+        if cached:
+            self._populated_from_cache.add(zone_name)
+        else:
+            self._populated_from_cache.discard(zone_name)
 
-                    if record_by_name.endswith(zone.name[:-1]):
-                        record_name = record_by_name[:-(len(zone.name))]
-                    else:
-                        record_name = record_by_name
+        return listing
 
-                    record = Record.new(zone, record_name, data, source=self)
+    def _load_records(self, zone, listing, lenient, timings):
+        """Adds the records of the listing to the zone, remembering the ids
+        of their values. Returns a list of tuples of each record added and
+        the (content, id) of its values for the id index, or None when
+        there is no id index to store them in"""
+        # Kept for the whole zone, so only when they will be stored
+        loaded = [] if self.id_index is not None else None
+        zone_ids = ZoneIds()
 
-                    # Some lexicon operations, specifically 'update',
-                    # requires the 'identifier' to be used.
-                    # Since that information is in the 'id' key, we save it
-                    # in a dict from which it can be retrieved when applying
-                    #
-                    # Furthermore, where octodns saves multi value records as
-                    # single record, lexicon has one record for each value.
-                    # Therefore, the extra 'content' level is needed here, so
-                    # that correct ID for correct record might be retrieved.
-                    for lexicon_record in lexicon_records:
-                        self.remembered_ids.remember(record,
-                                                     lexicon_record['content'],
-                                                     lexicon_record['id'])
+        if self.streaming_populate:
+            grouped = self._group_sorted(listing)
+        else:
+            grouped = self._group(listing)
+
+        for record_by_name, record_type, lexicon_records in grouped:
+            started = perf_counter()
+            self.log.debug("Got {!s} from above".format(lexicon_records))
+
+            codec = self._codecs.get(record_type)
+            if codec is None:
+                err_str = 'encountered unhandled record type: ' \
+                          '"{}" Payload was "{!s}"'.format(record_type,
+                                                           lexicon_records)
+                self.log.warning(err_str)
+                continue
+
+            for lexicon_record in lexicon_records:
+                self._harmonize(zone, lexicon_record)
+            started = timings.lap('harmonize', started)
+
+            data = codec.parse(lexicon_records)
+            data['type'] = record_type
+            data['ttl'] = lexicon_records[0]['ttl']
+            started = timings.lap('parse_values', started)
+
+            self.log.debug('populate: adding record {} records: {!s}'
+                           .format(record_by_name, data))
+
+            if record_by_name.endswith(zone.name):
+                # This should be handled in the various
+                # Lexicon providers.
+                #  However, there is no harm in doing some extra
+                #  check for it here  - just in case.
+                record_by_name = record_by_name.rstrip('.')
+
+            if record_by_name.endswith(zone.name[:-1]):
+                record_name = record_by_name[:-(len(zone.name))]
+            else:
+                record_name = record_by_name
+
+            record = Record.new(zone, record_name, data, source=self)
+            timings.lap('record_new', started)
+
+            # Some lexicon operations, specifically 'update',
+            # requires the 'identifier' to be used.
+            # Since that information is in the 'id' key, we save it
+            # in a dict from which it can be retrieved when applying
+            #
+            # Furthermore, where octodns saves multi value records as
+            # single record, lexicon has one record for each value.
+            # Therefore, the extra 'content' level is needed here, so
+            # that correct ID for correct record might be retrieved.
+            ids = [(r['content'], r['id']) for r in lexicon_records]
+            for content, _id in ids:
+                zone_ids.remember(record, content, _id)
+
+            started = perf_counter()
+            zone.add_record(record, lenient=lenient)
+            timings.lap('add_record', started)
+            if loaded is not None:
+                loaded.append((record, ids))
+
+        # The ids of an earlier populate of the zone are all replaced
+        self.remembered_ids.replace(zone.name, zone_ids)
+
+        return loaded
+
+    def _group(self, listing):
+        """Yields the name, type and lexicon records of each name and type
+        in the listing"""
+        loaded_types = defaultdict(lambda: defaultdict(list))
 
-                    zone.add_record(record, lenient=lenient)
+        for lexicon_record in listing:
+            loaded_types[lexicon_record["name"]][lexicon_record["type"]] \
+                .append(lexicon_record)
 
+        for record_by_name, data_by_id in loaded_types.items():
+            for record_type, lexicon_records in data_by_id.items():
+                yield record_by_name, record_type, lexicon_records
+
+    def _group_sorted(self, listing):
+        """Like _group, but sorts the listing by name and type and takes the
+        lexicon records of each off it in turn, so that they can be freed
+        as soon as their record is built. Sorts a listing which is ordered
+        by name already in linear time."""
+        listing.sort(key=_name_and_type, reverse=True)
+
+        while listing:
+            lexicon_records = [listing.pop()]
+            name_and_type = _name_and_type(lexicon_records[0])
+            while listing and _name_and_type(listing[-1]) == name_and_type:
+                lexicon_records.append(listing.pop())
+            # As listed, the sort is stable
+            lexicon_records.reverse()
+            yield name_and_type + (lexicon_records,)
+
+    def _harmonize(self, zone, lexicon_record):
+        self.log.debug("provider listed {!s}".format(lexicon_record))
+
+        # harmonize record values here
+        if lexicon_record['type'] in ['CNAME', 'MX', 'NS', 'PTR']:
+            if not lexicon_record['content'][-1] == '.':
+                domain_part = split_content(lexicon_record['content'])[-1]
+                if '.' in domain_part:
+                    lexicon_record['content'] += '.'
                 else:
-                    err_str = 'encountered unhandled record type: ' \
-                              '"{}" Payload was "{!s}"'.format(record_type,
-                                                               lexicon_records)
-                    self.log.warning(err_str)
+                    lexicon_record['content'] += ".{}".format(zone.name)
 
-        self.log.info('populate:   found %s records, exists=%s',
-                      len(zone.records) - before, before < len(zone.records))
-
-        return exists
+                self.log.info("Harmonizing [%s] -> [%s]",
+                              domain_part, lexicon_record['content'])
 
     def _create_client(self, zone_name):
         config = LexiconConfigResolver()
@@ -174,11 +624,38 @@ class LexiconProvider(BaseProvider):
             .with_env().with_dict(self.lexicon_config)
 
         try:
-            return LexiconClient(config), dynamic_config
+            lexicon_client = LexiconClient(config)
         except AttributeError as e:
             self.log.error('Unable to parse config {!s}'.format(config))
             raise e
 
+        if self.rrset_update:
+            adapter = RRSET_ADAPTERS.get(lexicon_client.provider_name)
+            if adapter:
+                lexicon_client.provider = adapter(lexicon_client.provider)
+            elif not hasattr(lexicon_client.provider, 'replace_rrset'):
+                self.log.warning('rrset_update: not supported by %s, '
+                                 'updating value by value',
+                                 lexicon_client.provider_name)
+
+        if self.http_sessions:
+            # In the module of the lexicon provider, not of any proxy of it
+            POOLED_REQUESTS.install(_innermost(lexicon_client.provider))
+            lexicon_client.provider = PooledProvider(
+                lexicon_client.provider, self.http_sessions)
+
+        if self.rate_limiter:
+            lexicon_client.provider = RateLimitedProvider(
+                lexicon_client.provider, self.rate_limiter)
+
+        if self.api_metrics:
+            # Outermost, so that throttled calls are timed with their retries
+            lexicon_client.provider = MeteredProvider(
+                lexicon_client.provider, self.api_metrics, self.id,
+                zone_name)
+
+        return lexicon_client, dynamic_config
+
     def _apply(self, plan):
         """Required function of manager.py to actually apply a record change.
 
@@ -190,204 +667,1398 @@ class LexiconProvider(BaseProvider):
         desired = plan.desired
         changes = plan.changes
         zone_name = plan.existing.name[:-1]
-        lexicon_client, dynamic_config = self._create_client(zone_name)
 
         self.log.debug('_apply: zone=%s, len(changes)=%d', desired.name,
                        len(changes))
-        lexicon_client.provider.authenticate()
 
+        timings = PhaseTimings()
+        self.apply_stats = Counter()
+        memoized = None
+
+        try:
+            lexicon_client, dynamic_config = self.clients.get(zone_name,
+                                                              timings)
+
+            if plan.existing.name in self._populated_from_cache:
+                # The ids remembered for existing records may be stale, so
+                # always take them from a fresh listing before applying.
+                self._refresh_ids(plan.existing, timings)
+            elif plan.existing.records and \
+                    plan.existing.name not in self.remembered_ids:
+                # Not populated by this process, e.g. when planned by
+                # another, or its ids have been forgotten since
+                if self.id_index is not None:
+                    self._load_ids(plan.existing, timings)
+                else:
+                    self._refresh_ids(plan.existing, timings)
+            else:
+                self.remembered_ids.touch(plan.existing.name)
+
+            lexicon_provider = lexicon_client.provider
+            if self.memoize_listings:
+                lexicon_provider = memoized = \
+                    MemoizedListings(lexicon_provider)
+                memoized.install()
+
+            if self.apply_max_workers > 1:
+                self._apply_concurrently(lexicon_provider, dynamic_config,
+                                         changes, timings)
+            else:
+                for change in changes:
+                    self._apply_change(lexicon_provider, dynamic_config,
+                                       change, timings)
+        finally:
+            # Without an identifier, most lexicon providers have to list
+            # records to find the one to delete
+            self.log.info('_apply: %d deletes, %d of them by content',
+                          self.apply_stats['deletes'],
+                          self.apply_stats['deletes_by_content'])
+            if memoized:
+                memoized.uninstall()
+                self.log.info('_apply: %d listings made, %d memoized',
+                              memoized.listed, memoized.served)
+            if self.id_index is not None:
+                # The zone has changed, the persisted ids are no longer
+                # valid for the existing records of any plan
+                self.id_index.discard(plan.existing.name)
+            self._report_timings('_apply', plan.existing.name, timings)
+            if self.api_metrics is not None:
+                self.api_metrics.write()
+
+    def _report_timings(self, operation, zone_name, timings):
+        summary = timings.summary(self.id, operation, zone_name)
+        self.log.info('%s: %s took %.3fs, %s', operation, zone_name,
+                      summary['seconds'], ', '.join(
+                          '{} {:.3f}s/{}'.format(phase, p['seconds'],
+                                                 p['calls'])
+                          for phase, p in summary['phases'].items()))
+
+        if self.metrics_hook is not None:
+            try:
+                self.metrics_hook(summary)
+            except Exception as e:
+                # Metrics are not worth failing a sync over
+                self.log.warning('metrics_hook: failed on %s: %s',
+                                 zone_name, e)
+
+    def _refresh_ids(self, existing, timings):
+        self.log.info('_apply: refreshing ids of %s', existing.name)
+
+        listing = self._list_zone(existing.name, timings, fresh=True)
+        loaded = self._load_records(Zone(existing.name, []), listing,
+                                    lenient=True, timings=timings)
+        if self.id_index is not None:
+            self.id_index.store(existing.name, loaded)
+
+    def _load_ids(self, existing, timings):
+        ids = self.id_index.load(existing.name, existing.records)
+        if ids is None:
+            self._refresh_ids(existing, timings)
+            return
+
+        self.log.info('_apply: ids of %s loaded from index', existing.name)
+        zone_ids = ZoneIds()
+        for record in existing.records:
+            for content, _id in ids.get((record.name, record._type), []):
+                zone_ids.remember(record, content, _id)
+        self.remembered_ids.replace(existing.name, zone_ids)
+
+    def _apply_concurrently(self, lexicon_provider, dynamic_config, changes,
+                            timings):
+        # Changes for different names are independent of each other, but
+        # changes for the same name (e.g. a CNAME replaced by an A record)
+        # must be applied in the order octodns planned them.
+        changes_by_name = OrderedDict()
         for change in changes:
-            _rrset_func = getattr(
-                self, '_rrset_for_{}'.format(change.record._type))
+            changes_by_name.setdefault(change.record.fqdn, []).append(change)
+
+        # The TTL of each operation is overlaid per thread on the dynamic
+        # config, so all workers can share one authenticated client.
+        def apply_changes(changes_for_name):
+            for change in changes_for_name:
+                try:
+                    self._apply_change(lexicon_provider, dynamic_config,
+                                       change, timings)
+                except Exception as e:
+                    self.log.error('_apply: failed on %s: %s',
+                                   change.record.fqdn, e)
+                    # Later changes for this name may depend on this one
+                    return e
+
+        max_workers = min(self.apply_max_workers, len(changes_by_name))
+        self.log.info('_apply: %d names on %d workers',
+                      len(changes_by_name), max_workers)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(apply_changes,
+                                        changes_by_name.values()))
+
+        errors = [e for e in results if e is not None]
+        if errors:
+            raise ApplyErrors(errors)
+
+    def _apply_change(self, lexicon_provider, dynamic_config, change,
+                      timings):
+        # Only way to update TTL is to hope that the provider shall read
+        # this one for all operations
+        with dynamic_config.ttl_overlay(change.record.ttl):
+            self._apply_rrset_change(lexicon_provider, change, timings)
+
+    def _apply_rrset_change(self, lexicon_provider, change, timings):
+        old_vars = self._rrset_for(change.existing) \
+            if change.existing else set()
+        new_vars = self._rrset_for(change.new) \
+            if change.new else set()
+
+        additions = new_vars - old_vars
+        deletions = old_vars - new_vars
+
+        if (additions or deletions) and self.rrset_update and \
+                hasattr(lexicon_provider, 'replace_rrset'):
+            contents = sorted(r.content for r in new_vars)
+            self.log.info('client replace_rrset %s %s %s',
+                          change.record._type, change.record.fqdn, contents)
+
+            if not timings.call(
+                    'replace_rrset', lexicon_provider.replace_rrset,
+                    rtype=change.record._type, name=change.record.fqdn,
+                    contents=contents):
+                raise RecordUpdateError(change.record)
+            return
+
+        updates, creates, deletes = self._match_values(
+            change.existing, additions, deletions)
+
+        for identifier, new_record in updates:
+            self.log.info('client update [id:{}] {!s}'.format(
+                identifier, new_record))
+
+            if not timings.call(
+                    'update_record', lexicon_provider.update_record,
+                    identifier=identifier, **new_record.func_args()):
+                raise RecordUpdateError(new_record, identifier)
+
+        # Creating a value which is already there is a no-op for most
+        # lexicon providers, so a value re-created with another TTL must be
+        # deleted first. All other values are deleted only once the new
+        # ones are in place.
+        recreated = {r.content for r in creates}
+        deletes_first = [r for r in deletes if r.content in recreated]
+        deletes_last = [r for r in deletes if r.content not in recreated]
+
+        for old_record in deletes_first:
+            self._delete_value(lexicon_provider, change.existing, old_record,
+                               timings)
+
+        for new_record in creates:
+            self.log.info('client create_record {!s}'.format(new_record))
+            if not timings.call('create_record',
+                                lexicon_provider.create_record,
+                                **new_record.func_args()):
+                raise RecordCreateError(new_record)
+
+        for old_record in deletes_last:
+            self._delete_value(lexicon_provider, change.existing, old_record,
+                               timings)
+
+    def _match_values(self, existing, additions, deletions):
+        """Pairs values to delete with values to add, so that as many of
+        them as possible are updated in place by identifier.
+
+        Returns a list of (identifier, new value) updates, and the lists of
+        values left over to create and to delete.
+        """
+        # A value can only be updated in place if its identifier does not
+        # also belong to other values of the record, see has_unique_ids
+        identifiers = {}
+        for old_record in deletions:
+            identifier = self.remembered_ids.get(existing, old_record.content)
+            if identifier and self.remembered_ids.is_unique_id(existing,
+                                                               identifier):
+                identifiers[old_record] = identifier
+
+        updatable = sorted(identifiers)
+        additions_by_content = {r.content: r for r in additions}
+        pairs = []
+
+        # Values where only the TTL changed are paired with themselves
+        for old_record in updatable:
+            new_record = additions_by_content.pop(old_record.content, None)
+            if new_record:
+                pairs.append((old_record, new_record))
+
+        paired = {old_record for old_record, _ in pairs}
+        pairs.extend(zip([r for r in updatable if r not in paired],
+                         sorted(additions_by_content.values())))
+
+        updated_old = {old_record for old_record, _ in pairs}
+        updated_new = {new_record for _, new_record in pairs}
+
+        return [(identifiers[old_record], new_record)
+                for old_record, new_record in pairs], \
+            [r for r in sorted(additions) if r not in updated_new], \
+            [r for r in sorted(deletions) if r not in updated_old]
+
+    def _delete_value(self, lexicon_provider, existing, old_record,
+                      timings):
+        self.log.info('client delete_record {!s}'.format(old_record))
+        identifier = self.remembered_ids.get(existing, old_record.content)
+        if not self.remembered_ids.is_unique_id(existing, identifier):
+            self.log.debug('_delete_value: no unique id for %s (%s), '
+                           'deleting by content', old_record, identifier)
+            identifier = None
+
+        self._count('deletes')
+        if identifier is None:
+            self._count('deletes_by_content')
+
+        if not timings.call('delete_record', lexicon_provider.delete_record,
+                            identifier=identifier, **old_record.func_args()):
+            raise RecordDeleteError(old_record)
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.apply_stats[key] += 1
+
+    def _rrset_for(self, octodns_record):
+        # All values share the name and type, which are only looked up (the
+        # fqdn is formatted anew every time) and interned once per record
+        ttl = octodns_record.ttl
+        rtype = intern(octodns_record._type)
+        name = intern(octodns_record.fqdn)
+        return {LexiconRecord(content, ttl, rtype, name) for content
+                in self._codecs[octodns_record._type].format(octodns_record)}
+
+
+def _make_directory(directory):
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+
+def _path_in(directory, filename):
+    """Returns the path of filename in directory, with anything but word
+    characters, dots and dashes in filename replaced"""
+    return os.path.join(directory, re.sub(r'[^\w.-]', '_', filename))
+
+
+def _write_atomically(path, text):
+    tmp_path = '{}.{}.tmp'.format(path, current_thread().ident)
+    with open(tmp_path, 'w') as fh:
+        fh.write(text)
+    # Readers (e.g. another process loading a cached listing, or the node
+    # exporter's textfile collector) never see a partially written file
+    os.rename(tmp_path, path)
+
+
+def _resolve_callable(func):
+    """Returns func, or the callable its dotted path names"""
+    if callable(func):
+        return func
+
+    module_name, _, name = func.rpartition('.')
+    return getattr(importlib.import_module(module_name), name)
+
+
+class PhaseTimings:
+    """Time spent in, and the number of calls of, each phase of one
+    populate or _apply. Shared by the threads applying changes
+    concurrently."""
 
-            # Only way to update TTL is to hope that the provider shall read
-            # this one for all operations
-            dynamic_config.set_ttl(change.record.ttl)
+    def __init__(self):
+        self.lock = Lock()
+        self.started = perf_counter()
+        self.seconds = OrderedDict()
+        self.calls = Counter()
+
+    def lap(self, phase, started):
+        """Adds the time since started to the phase, and returns the
+        current time, from which the next phase can be timed"""
+        now = perf_counter()
+        with self.lock:
+            self.seconds[phase] = self.seconds.get(phase, 0) + now - started
+            self.calls[phase] += 1
+        return now
 
-            old_vars = _rrset_func(change.existing) \
-                if change.existing else set()
-            new_vars = _rrset_func(change.new) \
-                if change.new else set()
+    def call(self, phase, func, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.lap(phase, started)
 
-            additions = new_vars - old_vars
-            deletions = old_vars - new_vars
+    def summary(self, provider_id, operation, zone_name):
+        with self.lock:
+            phases = OrderedDict(
+                (phase, {'seconds': seconds, 'calls': self.calls[phase]})
+                for phase, seconds in self.seconds.items())
 
-            additions_iter = iter(sorted(additions))
-            deletions_iter = iter(sorted(deletions))
+        return OrderedDict([
+            ('provider', provider_id),
+            ('operation', operation),
+            ('zone', zone_name),
+            ('seconds', perf_counter() - self.started),
+            ('phases', phases),
+        ])
 
-            for i in range(0, min(len(additions), len(deletions))):
-                new_record = next(additions_iter)
-                old_record = next(deletions_iter)
-                identifier = self.remembered_ids.get(change.existing,
-                                                     old_record.content)
 
-                if identifier and self.remembered_ids.has_unique_ids(
-                        change.existing):
+class ZoneProfiler:
+    """Profiles operations on zones one by one, writing a profile of each,
+    and keeps the functions most time was spent in across all of them"""
 
-                    self.log.info('client update [id:{}] {!s}'.format(
-                        identifier, new_record))
+    MODES = ('deterministic', 'sampling')
 
-                    if not lexicon_client.provider.update_record(
-                            identifier=identifier, **new_record.func_args()):
-                        raise RecordUpdateError(new_record, identifier)
+    def __init__(self, provider_id, directory, mode='deterministic',
+                 interval=0.005, top=20):
+        if mode not in self.MODES:
+            raise ValueError('profile: mode must be one of {}, not {}'
+                             .format(', '.join(self.MODES), mode))
 
+        self.log = logging.getLogger('ZoneProfiler[{}]'.format(provider_id))
+        self.lock = Lock()
+        self.tracing = Lock()
+        self.provider_id = provider_id
+        self.directory = directory
+        self.mode = mode
+        self.interval = interval
+        self.top = top
+        self.profiled = 0
+        self.stats = None
+        self.samples = Counter()
+
+        _make_directory(directory)
+
+        atexit.register(self.report)
+
+    def _path(self, operation, zone_name):
+        filename = '{}-{}{}.{}'.format(
+            self.provider_id, zone_name, operation.lstrip('_'),
+            'pstats' if self.mode == 'deterministic' else 'collapsed')
+        return _path_in(self.directory, filename)
+
+    def profile(self, operation, zone_name, func, *args, **kwargs):
+        path = self._path(operation, zone_name)
+        if self.mode == 'sampling':
+            return self._sample(path, func, *args, **kwargs)
+        return self._trace(path, func, *args, **kwargs)
+
+    def _trace(self, path, func, *args, **kwargs):
+        # Only one deterministic profiler may be active at a time. Rather
+        # than waiting for it, operations overlapping it run unprofiled.
+        if not self.tracing.acquire(False):
+            self.log.debug('profile: not writing %s, another operation is '
+                           'being profiled', path)
+            return func(*args, **kwargs)
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+            return func(*args, **kwargs)
+        finally:
+            profiler.disable()
+            self.tracing.release()
+            profiler.dump_stats(path)
+
+            stats = pstats.Stats(profiler)
+            with self.lock:
+                if self.stats is None:
+                    self.stats = stats
                 else:
-                    self.log.info(
-                        'client create_record {!s}'.format(new_record))
-
-                    if not lexicon_client.provider.create_record(
-                            **new_record.func_args()):
-                        raise RecordCreateError(new_record)
-
-                    self.log.info('client delete_record {!s}'.format(
-                        old_record))
-                    if not lexicon_client.provider.delete_record(
-                            **old_record.func_args()):
-                        raise RecordDeleteError(old_record)
-
-            for new_record in additions_iter:
-                self.log.info('client create_record {!s}'.format(new_record))
-                if not lexicon_client.provider.create_record(
-                        **new_record.func_args()):
-                    raise RecordCreateError(new_record)
-
-            for old_record in deletions_iter:
-                self.log.info('client delete_record {!s}'.format(old_record))
-                identifier = self.remembered_ids.get(change.existing,
-                                                     old_record.content)
-
-                if not lexicon_client.provider.delete_record(
-                        identifier=identifier, **old_record.func_args()):
-                    raise RecordDeleteError(old_record)
-
-    def _data_for_multiple(self, _type, lexicon_records):
-        return {
-            'ttl': lexicon_records[0]['ttl'],
-            'type': _type,
-            'values': [re.sub(';', '\;', r['content']) for r in lexicon_records]
-        }
+                    self.stats.add(stats)
+                self.profiled += 1
+
+    def _sample(self, path, func, *args, **kwargs):
+        thread_id = current_thread().ident
+        stacks = Counter()
+        done = Event()
+
+        def sample():
+            while not done.wait(self.interval):
+                frame = sys._current_frames().get(thread_id)
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{} ({}:{})'.format(
+                        code.co_name, os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                stacks[';'.join(reversed(stack))] += 1
+
+        sampler = Thread(target=sample, name='ZoneProfiler:sampler')
+        sampler.daemon = True
+        sampler.start()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            done.set()
+            sampler.join()
+
+            with open(path, 'w') as fh:
+                for stack, samples in stacks.items():
+                    fh.write('{} {}\n'.format(stack, samples))
+
+            with self.lock:
+                for stack, samples in stacks.items():
+                    self.samples[stack.rsplit(';', 1)[-1]] += samples
+                self.profiled += 1
+
+    def hotspots(self):
+        """Returns the functions most time was spent in, not counting the
+        functions they called, as (function, seconds) when deterministic
+        and (function, samples) when sampling"""
+        with self.lock:
+            if self.mode == 'sampling':
+                return self.samples.most_common(self.top)
+            if self.stats is None:
+                return []
+
+            by_own_time = sorted(self.stats.stats.items(),
+                                 key=lambda item: item[1][2], reverse=True)
+            return [('{} ({}:{})'.format(name, os.path.basename(filename),
+                                         line), own_time)
+                    for (filename, line, name), (_, _, own_time, _, _)
+                    in by_own_time[:self.top]]
+
+    def report(self):
+        hotspots = self.hotspots()
+        if not hotspots:
+            return
+
+        self.log.info('report: top %d hotspots of %d operations, profiles '
+                      'are in %s', len(hotspots), self.profiled,
+                      self.directory)
+        for function, own in hotspots:
+            if self.mode == 'sampling':
+                self.log.info('report: %8d samples  %s', own, function)
+            else:
+                self.log.info('report: %9.3fs  %s', own, function)
+
+
+class LexiconClientPool:
+
+    def __init__(self, create_client, max_age=300):
+        self.lock = Lock()
+        self.max_age = max_age
+        self._create_client = create_client
+        self._clients = {}
+        self._zone_locks = defaultdict(Lock)
+
+    def get(self, zone_name, timings=None):
+        # Authenticating usually costs (at least) one round trip to look up
+        # the domain id, which the lexicon provider then keeps for itself.
+        # Hold on to the authenticated client so that populate and apply
+        # of the same zone only pay for it once.
+        with self.lock:
+            zone_lock = self._zone_locks[zone_name]
 
-    def _data_for_CAA(self, _type, lexicon_records):
-        values = []
-        for record in lexicon_records:
-            flags, tag, value = shlex.split(record["content"])
-            values.append({
-                'flags': flags,
-                'tag': tag,
-                'value': value
-            })
-        return {
-            'ttl': lexicon_records[0]['ttl'],
-            'type': _type,
-            'values': values
-        }
+        with zone_lock:
+            lexicon_client, dynamic_config, created = \
+                self._clients.get(zone_name, (None, None, 0))
 
-    def _data_for_CNAME(self, _type, lexicon_records):
-        record = lexicon_records[0]
-        return {
-            'ttl': record['ttl'],
-            'type': _type,
-            'value': record['content']
-        }
+            if lexicon_client is None or time() - created >= self.max_age:
+                if timings is None:
+                    timings = PhaseTimings()
+                lexicon_client, dynamic_config = timings.call(
+                    'create_client', self._create_client, zone_name)
+                timings.call('authenticate',
+                             lexicon_client.provider.authenticate)
+                self._clients[zone_name] = \
+                    (lexicon_client, dynamic_config, time())
 
-    def _data_for_MX(self, _type, lexicon_records):
-        values = []
-        for record in lexicon_records:
-            priority, exchange = shlex.split(record["content"])
-            values.append({"priority": priority, "exchange": exchange})
+            return lexicon_client, dynamic_config
 
-        return {
-            'ttl': lexicon_records[0]['ttl'],
-            'type': _type,
-            'values': values
-        }
 
-    def _data_for_SRV(self, _type, lexicon_records):
-        values = []
-        for record in lexicon_records:
-            priority, weight, port, target = shlex.split(record['content'])
-
-            values.append({
-                'priority': priority,
-                'weight': weight,
-                'port': port,
-                'target': target
-            })
-        return {
-            'type': _type,
-            'ttl': lexicon_records[0]['ttl'],
-            'values': values
+class HttpSessionPool:
+
+    def __init__(self, pool_size=10, keep_alive=True):
+        self.lock = Lock()
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
+        self._sessions = {}
+
+    def session_for(self, url):
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+
+        with self.lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1,
+                                      pool_maxsize=self.pool_size)
+                session.mount('{}://{}'.format(*host), adapter)
+                # Like the requests module API, keep no cookies between
+                # requests, which may be made with different credentials
+                session.cookies.set_policy(
+                    DefaultCookiePolicy(allowed_domains=[]))
+                if not self.keep_alive:
+                    session.headers['Connection'] = 'close'
+                self._sessions[host] = session
+
+        return session
+
+    def request(self, method, url, **kwargs):
+        return self.session_for(url).request(method, url, **kwargs)
+
+
+class PooledRequests:
+    """
+    Lexicon providers issue their HTTP calls through the module level
+    requests API, which sets up a new connection (and TLS handshake) for
+    every single call. Installed in place of requests in the module of a
+    lexicon provider, this sends the calls made while a pool is in use on
+    the calling thread through that pool, and all others through requests
+    itself, so that every LexiconProvider only ever uses its own pool.
+    """
+
+    def __init__(self):
+        self._current = local()
+
+    @property
+    def pool(self):
+        return getattr(self._current, 'pool', None)
+
+    @contextmanager
+    def using(self, pool):
+        previous = self.pool
+        self._current.pool = pool
+        try:
+            yield
+        finally:
+            self._current.pool = previous
+
+    def install(self, lexicon_provider):
+        module = sys.modules.get(type(lexicon_provider).__module__)
+        if getattr(module, 'requests', None) is requests:
+            module.requests = self
+
+    def uninstall(self, lexicon_provider):
+        module = sys.modules.get(type(lexicon_provider).__module__)
+        if getattr(module, 'requests', None) is self:
+            module.requests = requests
+
+    def request(self, method, url, **kwargs):
+        pool = self.pool
+        if pool is None:
+            return requests.request(method, url, **kwargs)
+        return pool.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.request('PATCH', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def __getattr__(self, name):
+        # exceptions, auth helpers et al are looked up on requests itself
+        return getattr(requests, name)
+
+
+POOLED_REQUESTS = PooledRequests()
+
+
+class RateLimiter:
+
+    THROTTLED_STATUS_CODES = {429, 503}
+
+    def __init__(self, rate=10, burst=None, max_retries=5, backoff=1,
+                 max_backoff=60):
+        self.log = logging.getLogger('RateLimiter')
+        self.lock = Lock()
+        self.max_rate = float(rate)
+        self.min_rate = self.max_rate / 64
+        self.rate = self.max_rate
+        self.burst = burst or rate
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.tokens = self.burst
+        self.updated = time()
+        self.throttled = 0
+
+    def acquire(self):
+        # Token bucket, where a caller that finds it empty takes its token
+        # anyway (going into debt) and sleeps until it would have been
+        # there. Callers after it so queue up behind it, in order.
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst,
+                              self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if wait > 0:
+            sleep(wait)
+
+    def _on_success(self):
+        # Additive increase, multiplicative decrease: speed back up slowly
+        # while calls go through, and halve the rate whenever throttled.
+        # This settles close to the highest rate the API accepts.
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+    def _on_throttled(self):
+        with self.lock:
+            self.throttled += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+
+    def _is_throttled(self, error):
+        response = getattr(error, 'response', None)
+        return getattr(response, 'status_code', None) in \
+            self.THROTTLED_STATUS_CODES
+
+    def _backoff_for(self, attempt, error):
+        # Exponential backoff with full jitter, but never shorter than
+        # what the API asked for with Retry-After
+        delay = random.uniform(
+            0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        try:
+            retry_after = float(error.response.headers['Retry-After'])
+        except (KeyError, TypeError, ValueError):
+            retry_after = 0
+        return max(delay, min(retry_after, self.max_backoff))
+
+    def call(self, func, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            try:
+                result = func(*args, **kwargs)
+            except requests.HTTPError as e:
+                if not self._is_throttled(e) or attempt >= self.max_retries:
+                    raise
+                self._on_throttled()
+                delay = self._backoff_for(attempt, e)
+                self.log.warning('call: throttled (%s), retrying in %.2fs, '
+                                 'rate now %.2f/s',
+                                 e.response.status_code, delay, self.rate)
+                sleep(delay)
+                attempt += 1
+            else:
+                self._on_success()
+                return result
+
+
+class ProviderProxy(object):
+    """Wraps a lexicon provider, for doing something around the calls made
+    to it. Anything not overridden is looked up on the wrapped provider.
+    Subclasses override _call, through which all the calls are made."""
+
+    def __init__(self, provider):
+        self.wrapped = provider
+
+    def __getattr__(self, name):
+        return getattr(self.wrapped, name)
+
+    def _call(self, operation, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    def authenticate(self):
+        return self._call('authenticate', self.wrapped.authenticate)
+
+    def list_records(self, *args, **kwargs):
+        return self._call('list_records', self.wrapped.list_records,
+                          *args, **kwargs)
+
+    def create_record(self, *args, **kwargs):
+        return self._call('create_record', self.wrapped.create_record,
+                          *args, **kwargs)
+
+    def update_record(self, *args, **kwargs):
+        return self._call('update_record', self.wrapped.update_record,
+                          *args, **kwargs)
+
+    def delete_record(self, *args, **kwargs):
+        return self._call('delete_record', self.wrapped.delete_record,
+                          *args, **kwargs)
+
+    @property
+    def replace_rrset(self):
+        # Raises AttributeError, like the wrapped provider would, when the
+        # wrapped provider has no replace_rrset
+        return partial(self._call, 'replace_rrset',
+                       self.wrapped.replace_rrset)
+
+
+def _innermost(provider):
+    """Returns the lexicon provider wrapped by any number of proxies"""
+    while isinstance(provider, ProviderProxy):
+        provider = provider.wrapped
+    return provider
+
+
+class RateLimitedProvider(ProviderProxy):
+
+    def __init__(self, provider, rate_limiter):
+        super(RateLimitedProvider, self).__init__(provider)
+        self.rate_limiter = rate_limiter
+
+    def _call(self, operation, func, *args, **kwargs):
+        return self.rate_limiter.call(func, *args, **kwargs)
+
+
+class PooledProvider(ProviderProxy):
+    """Puts the pool of a LexiconProvider in use around every call made to
+    the wrapped lexicon provider"""
+
+    def __init__(self, provider, pool):
+        super(PooledProvider, self).__init__(provider)
+        self.pool = pool
+
+    def _call(self, operation, func, *args, **kwargs):
+        with POOLED_REQUESTS.using(self.pool):
+            return func(*args, **kwargs)
+
+
+class MeteredProvider(ProviderProxy):
+
+    def __init__(self, provider, api_metrics, provider_id, zone_name):
+        super(MeteredProvider, self).__init__(provider)
+        self.api_metrics = api_metrics
+        self.labels = (('provider', provider_id), ('zone', zone_name))
+
+    def _call(self, operation, func, *args, **kwargs):
+        outcome = 'error'
+        started = perf_counter()
+        try:
+            result = func(*args, **kwargs)
+            # create, update and delete tell of failing by returning False
+            outcome = 'failure' if result is False else 'success'
+            return result
+        finally:
+            self.api_metrics.observe_call(self.labels, operation, outcome,
+                                          perf_counter() - started)
+
+    def list_records(self, *args, **kwargs):
+        records = list(super(MeteredProvider, self).list_records(
+            *args, **kwargs))
+        self.api_metrics.observe_listing(self.labels, len(records))
+        return records
+
+
+class Histogram:
+    """Cumulative counts of observed values up to each bucket bound"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+        self.counts[-1] += 1
+        self.count += 1
+        self.sum += value
+
+
+def _format_labels(labels):
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', '\\\\')
+                         .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels) + '}'
+
+
+class ApiMetrics:
+    """
+    Calls made to lexicon providers and records listed by them, exported
+    in the OpenMetrics text format:
+
+        lexicon_api_calls_total: calls by provider, zone, operation and
+            outcome (success, failure when False was returned, or error)
+        lexicon_api_call_seconds: histogram of the latency of the calls by
+            provider, zone and operation
+        lexicon_listed_records: histogram of the number of records of the
+            listings by provider and zone
+    """
+
+    CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; ' \
+                   'charset=utf-8'
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5,
+                       10, 30)
+    LISTING_BUCKETS = (0, 10, 100, 1000, 10000, 100000, 1000000)
+
+    _shared = {}
+    _shared_lock = Lock()
+
+    @classmethod
+    def shared(cls, file=None, port=None, host='127.0.0.1'):
+        """Returns the metrics of all providers exporting to the same file
+        and port, so that they neither overwrite each other's file nor
+        compete for the port"""
+        key = (file, port, host)
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = cls(file, port, host)
+            return cls._shared[key]
+
+    def __init__(self, file=None, port=None, host='127.0.0.1'):
+        self.lock = Lock()
+        self.file = file
+        self.calls = Counter()
+        self.latencies = OrderedDict()
+        self.listings = OrderedDict()
+        self.server = None
+
+        if port is not None:
+            self.server = MetricsServer((host, port), self)
+            thread = Thread(target=self.server.serve_forever,
+                            name='ApiMetrics:{}'.format(port))
+            thread.daemon = True
+            thread.start()
+
+    def observe_call(self, labels, operation, outcome, seconds):
+        labels = labels + (('operation', operation),)
+        with self.lock:
+            self.calls[labels + (('outcome', outcome),)] += 1
+            if labels not in self.latencies:
+                self.latencies[labels] = Histogram(self.LATENCY_BUCKETS)
+            self.latencies[labels].observe(seconds)
+
+    def observe_listing(self, labels, records):
+        with self.lock:
+            if labels not in self.listings:
+                self.listings[labels] = Histogram(self.LISTING_BUCKETS)
+            self.listings[labels].observe(records)
+
+    def render(self):
+        lines = [
+            '# TYPE lexicon_api_calls counter',
+            '# HELP lexicon_api_calls Calls made to lexicon providers.',
+        ]
+        with self.lock:
+            for labels, value in sorted(self.calls.items()):
+                lines.append('lexicon_api_calls_total{} {}'.format(
+                    _format_labels(labels), value))
+
+            self._render_histograms(
+                lines, 'lexicon_api_call_seconds',
+                'Latency of the calls made to lexicon providers.',
+                self.latencies)
+            self._render_histograms(
+                lines, 'lexicon_listed_records',
+                'Records listed by lexicon providers per listing.',
+                self.listings)
+
+        lines.append('# EOF')
+        return '\n'.join(lines) + '\n'
+
+    def _render_histograms(self, lines, name, help, histograms):
+        lines.append('# TYPE {} histogram'.format(name))
+        lines.append('# HELP {} {}'.format(name, help))
+        for labels, histogram in histograms.items():
+            bounds = [repr(float(b)) for b in histogram.buckets] + ['+Inf']
+            for bound, value in zip(bounds, histogram.counts):
+                lines.append('{}_bucket{} {}'.format(
+                    name, _format_labels(labels + (('le', bound),)), value))
+            lines.append('{}_count{} {}'.format(
+                name, _format_labels(labels), histogram.count))
+            lines.append('{}_sum{} {}'.format(
+                name, _format_labels(labels), histogram.sum))
+
+    def write(self):
+        if self.file is not None:
+            _write_atomically(self.file, self.render())
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if urlsplit(self.path).path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.api_metrics.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', ApiMetrics.CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes are not worth logging
+        pass
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, address, api_metrics):
+        HTTPServer.__init__(self, address, MetricsHandler)
+        self.api_metrics = api_metrics
+
+
+class MemoizedListings(ProviderProxy):
+    """
+    Many lexicon providers list the zone themselves to find the record to
+    update or delete, or to check that a record to create is not already
+    there, so that applying N changes lists the zone N times.
+
+    While installed, this serves those listings from one snapshot of the
+    zone, and keeps the snapshot up to date with the changes made through
+    it.
+    """
+
+    def __init__(self, provider):
+        super(MemoizedListings, self).__init__(provider)
+        self.lock = Lock()
+        self.snapshot = None
+        self.listed = 0
+        self.served = 0
+
+        self.lexicon_provider = _innermost(provider)
+
+    def install(self):
+        self._list_records = self.lexicon_provider._list_records
+        self.lexicon_provider._list_records = self._memoized_list_records
+
+    def uninstall(self):
+        vars(self.lexicon_provider).pop('_list_records', None)
+
+    def _full_name(self, name):
+        return self.lexicon_provider._full_name(name).lower()
+
+    def _matches(self, record, rtype, name, content):
+        return (rtype is None or record['type'] == rtype) and \
+            (name is None or
+             self._full_name(record['name']) == self._full_name(name)) and \
+            (content is None or record['content'] == content)
+
+    def _memoized_list_records(self, rtype=None, name=None, content=None):
+        with self.lock:
+            if self.snapshot is None:
+                self.snapshot = [dict(r) for r in
+                                 self._list_records(None, None, None)]
+                self.listed += 1
+            else:
+                self.served += 1
+
+            return [dict(r) for r in self.snapshot
+                    if self._matches(r, rtype, name, content)]
+
+    def create_record(self, rtype=None, name=None, content=None):
+        created = self.wrapped.create_record(rtype=rtype, name=name,
+                                             content=content)
+        with self.lock:
+            if created and self.snapshot is not None:
+                # The identifier of the new record is not known, but
+                # nothing in the same apply will look for it
+                self.snapshot.append({
+                    'type': rtype, 'name': self._full_name(name),
+                    'ttl': self.lexicon_provider._get_lexicon_option('ttl'),
+                    'content': content, 'id': None})
+        return created
+
+    def update_record(self, identifier=None, rtype=None, name=None,
+                      content=None):
+        updated = self.wrapped.update_record(identifier=identifier,
+                                             rtype=rtype, name=name,
+                                             content=content)
+        with self.lock:
+            if updated and self.snapshot is not None:
+                for record in self.snapshot:
+                    if record['id'] == identifier:
+                        record['content'] = content
+                        record['ttl'] = self.lexicon_provider \
+                            ._get_lexicon_option('ttl')
+        return updated
+
+    def delete_record(self, identifier=None, rtype=None, name=None,
+                      content=None):
+        deleted = self.wrapped.delete_record(identifier=identifier,
+                                             rtype=rtype, name=name,
+                                             content=content)
+        with self.lock:
+            if deleted and self.snapshot is not None:
+                self.snapshot = [
+                    r for r in self.snapshot if not (
+                        r['id'] == identifier if identifier is not None
+                        else self._matches(r, rtype, name, content))]
+        return deleted
+
+
+class PowerDNSRRSets(ProviderProxy):
+    """The PowerDNS API only knows of replacing whole rrsets, which lexicon
+    hides behind single value operations. This exposes it directly."""
+
+    def replace_rrset(self, rtype, name, contents):
+        provider = self.wrapped
+        rrset = {
+            'name': provider._fqdn_name(name),
+            'type': rtype,
+            'ttl': provider._get_lexicon_option('ttl') or 600,
+            'changetype': 'REPLACE' if contents else 'DELETE',
+            'records': [{'content': provider._clean_content(rtype, c),
+                         'disabled': False} for c in contents]
         }
 
-    _data_for_A = _data_for_multiple
+        provider._patch('/zones/' + provider._ensure_dot(provider.domain),
+                        data={'rrsets': [rrset]})
+        provider.notify_slaves()
+        provider._zone_data = None
+        return True
 
-    _data_for_AAAA = _data_for_multiple
 
-    _data_for_ALIAS = _data_for_CNAME
+# lexicon providers whose API can replace a whole rrset, by provider_name
+RRSET_ADAPTERS = {
+    'powerdns': PowerDNSRRSets,
+}
 
-    _data_for_NS = _data_for_multiple
 
-    _data_for_TXT = _data_for_multiple
+class ZoneListingCache:
 
-    def _rrset_for_multiple(self, octodns_record):
-        return {LexiconRecord(content=c,
-                              ttl=octodns_record.ttl,
-                              rtype=octodns_record._type,
-                              name=octodns_record.fqdn) for
-                c in octodns_record.values}
+    def __init__(self, provider_id, directory, max_age=60,
+                 stale_while_revalidate=False):
+        self.log = logging.getLogger(
+            'ZoneListingCache[{}]'.format(provider_id))
+        self.lock = Lock()
+        self.provider_id = provider_id
+        self.directory = directory
+        self.max_age = max_age
+        self.stale_while_revalidate = stale_while_revalidate
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self._revalidating = {}
+
+        _make_directory(directory)
+
+    def _path(self, zone_name):
+        filename = '{}-{}json'.format(self.provider_id, zone_name)
+        return _path_in(self.directory, filename)
+
+    def load(self, zone_name):
+        try:
+            with open(self._path(zone_name)) as fh:
+                cached = json.load(fh)
+        except (IOError, OSError, ValueError):
+            return None, None
+
+        return cached['records'], time() - cached['listed_at']
+
+    def store(self, zone_name, listing):
+        _write_atomically(self._path(zone_name), json.dumps(
+            {'zone': zone_name, 'listed_at': time(), 'records': listing}))
+
+    def get(self, zone_name, list_records):
+        """Returns a tuple of the listing of the zone and whether it came
+        from the cache or from list_records"""
+        listing, age = self.load(zone_name)
+
+        if listing is not None and age < self.max_age:
+            self.hits += 1
+            self.log.info('get: hit %s, age=%.1fs', zone_name, age)
+            return listing, True
+
+        if listing is not None and self.stale_while_revalidate:
+            self.stale_hits += 1
+            self.log.info('get: stale hit %s, age=%.1fs, revalidating',
+                          zone_name, age)
+            self._revalidate(zone_name, list_records)
+            return listing, True
+
+        self.misses += 1
+        self.log.info('get: miss %s', zone_name)
+        return self.refresh(zone_name, list_records), False
+
+    def refresh(self, zone_name, list_records):
+        listing = list_records()
+        self.store(zone_name, listing)
+        return listing
+
+    def _revalidate(self, zone_name, list_records):
+        with self.lock:
+            if zone_name in self._revalidating:
+                return
+            thread = Thread(target=self._run_revalidation,
+                            args=(zone_name, list_records))
+            thread.daemon = True
+            self._revalidating[zone_name] = thread
+        thread.start()
+
+    def _run_revalidation(self, zone_name, list_records):
+        try:
+            self.refresh(zone_name, list_records)
+        except Exception as e:
+            self.log.warning('_revalidate: failed for %s: %s', zone_name, e)
+        finally:
+            with self.lock:
+                del self._revalidating[zone_name]
+
+    def wait(self):
+        """Waits for all background revalidations to finish"""
+        with self.lock:
+            threads = list(self._revalidating.values())
+        for thread in threads:
+            thread.join()
 
-    def _rrset_for_CAA(self, octodns_record):
-        return {LexiconRecord(
-            content='{} {} "{}"'.format(c.flags, c.tag, c.value),
-            ttl=octodns_record.ttl,
-            rtype=octodns_record._type,
-            name=octodns_record.fqdn)
-            for c in octodns_record.values}
 
-    def _rrset_for_CNAME(self, octodns_record):
-        return {LexiconRecord(content=octodns_record.value,
-                              ttl=octodns_record.ttl,
-                              rtype=octodns_record._type,
-                              name=octodns_record.fqdn)}
+class ZoneIdIndex:
+    """
+    Lexicon identifiers of the values of each zone, persisted in sqlite
+    along with a digest of the records they were listed with
+    """
 
-    def _rrset_for_MX(self, octodns_record):
-        return {LexiconRecord(content='{} {}'.format(c.preference, c.exchange),
-                              ttl=octodns_record.ttl,
-                              rtype=octodns_record._type,
-                              name=octodns_record.fqdn)
-                for c in octodns_record.values}
+    def __init__(self, provider_id, directory):
+        self.log = logging.getLogger('ZoneIdIndex[{}]'.format(provider_id))
+        filename = '{}.sqlite'.format(provider_id)
+        self.path = _path_in(directory, filename)
+        self.hits = 0
+        self.misses = 0
+
+        _make_directory(directory)
+
+        with self._connect() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS zones '
+                       '(zone TEXT PRIMARY KEY, digest TEXT, stored_at REAL)')
+            db.execute('CREATE TABLE IF NOT EXISTS ids '
+                       '(zone TEXT, name TEXT, type TEXT, content TEXT, id)')
+            db.execute('CREATE INDEX IF NOT EXISTS ids_by_zone ON ids (zone)')
+
+    @contextmanager
+    def _connect(self):
+        # One connection per operation, as populate and _apply may run on
+        # different threads. The connection commits on leaving the block.
+        connection = sqlite3.connect(self.path, timeout=30)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    @staticmethod
+    def digest(records):
+        """Digest of the names, types and data of the records"""
+        lines = sorted('{} {} {}'.format(
+            record.name, record._type, json.dumps(record.data, sort_keys=True))
+            for record in records)
+        return hashlib.sha1('\n'.join(lines).encode('utf-8')).hexdigest()
+
+    def store(self, zone_name, loaded):
+        """Replaces the ids of the zone with those of the loaded records, as
+        returned by LexiconProvider._load_records"""
+        digest = self.digest(record for record, _ in loaded)
+        rows = [(zone_name, record.name, record._type, content, _id)
+                for record, ids in loaded
+                for content, _id in ids]
+
+        with self._connect() as db:
+            db.execute('DELETE FROM ids WHERE zone = ?', (zone_name,))
+            db.execute('INSERT OR REPLACE INTO zones VALUES (?, ?, ?)',
+                       (zone_name, digest, time()))
+            db.executemany('INSERT INTO ids VALUES (?, ?, ?, ?, ?)', rows)
+
+        self.log.debug('store: %d ids of %s', len(rows), zone_name)
+
+    def load(self, zone_name, records):
+        """Returns the ids of the zone as a dict of lists of (content, id)
+        by (name, type), or None if they were not listed with the records"""
+        with self._connect() as db:
+            stored = db.execute('SELECT digest FROM zones WHERE zone = ?',
+                                (zone_name,)).fetchone()
+            if stored is None or stored[0] != self.digest(records):
+                self.misses += 1
+                self.log.info('load: miss %s', zone_name)
+                return None
+
+            rows = db.execute('SELECT name, type, content, id FROM ids '
+                              'WHERE zone = ? ORDER BY rowid',
+                              (zone_name,)).fetchall()
+
+        self.hits += 1
+        ids = defaultdict(list)
+        for name, _type, content, _id in rows:
+            ids[(name, _type)].append((content, _id))
+        return ids
+
+    def discard(self, zone_name):
+        with self._connect() as db:
+            db.execute('DELETE FROM ids WHERE zone = ?', (zone_name,))
+            db.execute('DELETE FROM zones WHERE zone = ?', (zone_name,))
+
+
+class ZoneIds:
+    """
+    Lexicon ids of the values of the records of one zone, as listed by one
+    populate
+    """
+    # Rough size of the dict and Counter entries of each value, on top of
+    # its content and id
+    VALUE_OVERHEAD = 200
 
-    def _rrset_for_SRV(self, octodns_record):
-        return {LexiconRecord(
-            content='{} {} {} {}'.format(
-                c.priority, c.weight, c.port, c.target),
-            ttl=octodns_record.ttl,
-            rtype=octodns_record._type,
-            name=octodns_record.fqdn)
-            for c in octodns_record.values}
+    def __init__(self):
+        self.id_by_record_and_value = defaultdict(dict)
+        # How many values of each record an id was remembered for, and how
+        # many of those ids belong to more than one value, kept up to date
+        # so that uniqueness is known without going through all the ids
+        self.id_counts = defaultdict(Counter)
+        self.shared_ids = defaultdict(int)
+        self.entries = 0
+        self.bytes = 0
+        self.last_used = 0
+
+    @staticmethod
+    def _key(record):
+        # Lexicon values are remembered per octodns record, ie by name and
+        # type. Far cheaper to build than the repr of the record, which
+        # formats every value it has.
+        return intern(record.name), intern(record._type)
 
-    _rrset_for_A = _rrset_for_multiple
+    def remember(self, record, content, _id):
+        """Remembers the id of a value, returns the bytes it takes"""
+        key = self._key(record)
+        self.id_by_record_and_value[key][content] = _id
+        id_counts = self.id_counts[key]
+        id_counts[_id] += 1
+        if id_counts[_id] == 2:
+            self.shared_ids[key] += 1
+
+        size = sys.getsizeof(content) + sys.getsizeof(_id) + \
+            self.VALUE_OVERHEAD
+        self.entries += 1
+        self.bytes += size
+        return size
 
-    _rrset_for_AAAA = _rrset_for_multiple
+    def has_unique_ids(self, record):
+        return not self.shared_ids.get(self._key(record))
 
-    _rrset_for_ALIAS = _rrset_for_CNAME
+    def is_unique_id(self, record, _id):
+        id_counts = self.id_counts.get(self._key(record))
+        return id_counts is not None and id_counts[_id] == 1
 
-    _rrset_for_NS = _rrset_for_multiple
+    def get(self, record, content):
+        return self.id_by_record_and_value.get(self._key(record), {}) \
+            .get(content)
 
-    _rrset_for_TXT = _rrset_for_multiple
+    def get_all_ids(self, record):
+        id_counts = self.id_counts.get(self._key(record))
+        return list(id_counts.elements()) if id_counts else []
 
 
-class RememberedIds:
+class IdShard:
 
     def __init__(self):
         self.lock = Lock()
-        self._id_by_record_and_value = defaultdict(dict)
-        self._all_ids_for_record = defaultdict(list)
+        self.zones = {}
+        self.bytes = 0
+
+
+class RememberedIds:
+    """
+    Lexicon ids by zone. Each populate of a zone replaces all of its ids at
+    once, and the zones used least recently are forgotten when there are
+    more than max_zones of them, or when they take more than max_bytes.
+
+    Zones are spread over shards, each with its own lock, so that zones
+    populated in parallel do not wait for each other. Looking ids up takes
+    no lock at all.
+    """
+    SHARDS = 16
+
+    def __init__(self, max_zones=None, max_bytes=None, shards=SHARDS):
+        self.max_zones = max_zones
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self._shards = [IdShard() for _ in range(shards)]
+        self._eviction_lock = Lock()
+        self._clock = count(1)
+
+    def __contains__(self, zone_name):
+        return zone_name in self._shard(zone_name).zones
+
+    def _shard(self, zone_name):
+        return self._shards[hash(zone_name) % len(self._shards)]
+
+    def _zone_ids(self, record):
+        try:
+            zone_name = record.zone.name
+        except AttributeError:
+            return None
+        return self._shard(zone_name).zones.get(zone_name)
+
+    def replace(self, zone_name, zone_ids):
+        """Replaces all ids of the zone by those of zone_ids"""
+        shard = self._shard(zone_name)
+        zone_ids.last_used = next(self._clock)
+        with shard.lock:
+            previous = shard.zones.get(zone_name)
+            shard.zones[zone_name] = zone_ids
+            shard.bytes += zone_ids.bytes - \
+                (previous.bytes if previous is not None else 0)
+        self._evict(keep=zone_name)
 
     def remember(self, record, content, _id):
-        with self.lock:
-            self._id_by_record_and_value[repr(record)][content] = _id
-            self._all_ids_for_record[repr(record)].append(_id)
+        """Adds the id of a value to the ids of the zone of the record"""
+        zone_name = record.zone.name
+        shard = self._shard(zone_name)
+        with shard.lock:
+            zone_ids = shard.zones.get(zone_name)
+            if zone_ids is None:
+                zone_ids = shard.zones[zone_name] = ZoneIds()
+                zone_ids.last_used = next(self._clock)
+            shard.bytes += zone_ids.remember(record, content, _id)
+        self._evict(keep=zone_name)
+
+    def touch(self, zone_name):
+        """Marks the zone as the one used most recently"""
+        zone_ids = self._shard(zone_name).zones.get(zone_name)
+        if zone_ids is not None:
+            zone_ids.last_used = next(self._clock)
+
+    def _over_limits(self):
+        return (self.max_zones and sum(
+            len(shard.zones) for shard in self._shards) > self.max_zones) or \
+            (self.max_bytes and sum(
+                shard.bytes for shard in self._shards) > self.max_bytes)
+
+    def _evict(self, keep):
+        if not (self.max_zones or self.max_bytes):
+            return
+
+        with self._eviction_lock:
+            if not self._over_limits():
+                return
+            # Oldest first. The zone used most recently is always kept.
+            candidates = sorted(
+                (zone_ids.last_used, zone_name, shard)
+                for shard in self._shards
+                for zone_name, zone_ids in list(shard.zones.items())
+                if zone_name != keep)
+            for _, zone_name, shard in candidates:
+                with shard.lock:
+                    zone_ids = shard.zones.pop(zone_name, None)
+                    if zone_ids is not None:
+                        shard.bytes -= zone_ids.bytes
+                        self.evictions += 1
+                if not self._over_limits():
+                    return
+
+    def stats(self):
+        zones = [zone_ids for shard in self._shards
+                 for zone_ids in list(shard.zones.values())]
+        return {
+            'zones': len(zones),
+            'entries': sum(zone_ids.entries for zone_ids in zones),
+            'bytes': sum(shard.bytes for shard in self._shards),
+            'evictions': self.evictions,
+        }
 
     def has_unique_ids(self, record):
         # We *want* to use update op when ever possible, because it is
@@ -406,29 +2077,73 @@ class RememberedIds:
         # performed either if all the ids encountered are unique, or else
         # if there are only one value for that record present already, in
         # which case the id is unique simply by being the only one.
-        return len(self._all_ids_for_record[repr(record)]) == \
-            len(set(self._all_ids_for_record[repr(record)]))
+        zone_ids = self._zone_ids(record)
+        return zone_ids is None or zone_ids.has_unique_ids(record)
+
+    def is_unique_id(self, record, _id):
+        zone_ids = self._zone_ids(record)
+        return zone_ids is not None and zone_ids.is_unique_id(record, _id)
 
     def get(self, record, content):
-        try:
-            return self._id_by_record_and_value[repr(record)][content]
-        except KeyError:
-            return None
+        zone_ids = self._zone_ids(record)
+        return zone_ids.get(record, content) if zone_ids is not None \
+            else None
 
     def get_all_ids(self, record):
-        return self._all_ids_for_record[repr(record)]
+        """Returns the ids of all values of the record, grouped by id"""
+        zone_ids = self._zone_ids(record)
+        return zone_ids.get_all_ids(record) if zone_ids is not None \
+            else []
 
 
-class LexiconRecord(namedtuple('LexiconRecord', 'content ttl rtype name')):
+class LexiconRecord(object):
+    """
+    One value of an octodns record, as lexicon lists and takes it. Treated
+    as immutable: its hash is computed once, and there is no dict per value.
+    """
+    __slots__ = ('content', 'ttl', 'rtype', 'name', '_hash')
+
+    def __init__(self, content, ttl, rtype, name):
+        self.content = content
+        self.ttl = ttl
+        self.rtype = rtype
+        self.name = name
+        self._hash = hash((content, ttl, rtype, name))
+
+    def _astuple(self):
+        return self.content, self.ttl, self.rtype, self.name
+
+    def __hash__(self):
+        return self._hash
+
+    def __eq__(self, other):
+        return isinstance(other, LexiconRecord) and \
+            self._hash == other._hash and \
+            self._astuple() == other._astuple()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __lt__(self, other):
+        # Values of one rrset differ by content, which decides most of the
+        # comparisons made when sorting them
+        if self.content != other.content:
+            return self.content < other.content
+        return self._astuple() < other._astuple()
+
+    def __repr__(self):
+        return 'LexiconRecord(content={!r}, ttl={!r}, rtype={!r}, ' \
+            'name={!r})'.format(*self._astuple())
 
     def to_list_format(self):
         # function called is 'rtype' but list output of record names it 'type'
-        return {k if k != 'rtype' else 'type': v for k, v
-                in self._asdict().items()}
+        return {'content': self.content, 'ttl': self.ttl, 'type': self.rtype,
+                'name': self.name}
 
     def func_args(self):
         # TTL no argument for the functions.
-        return {k: getattr(self, k) for k in ['content', 'rtype', 'name']}
+        return {'content': self.content, 'rtype': self.rtype,
+                'name': self.name}
 
 
 class OnTheFlyLexiconConfigSource(LexiconConfigSource):
@@ -437,13 +2152,27 @@ class OnTheFlyLexiconConfigSource(LexiconConfigSource):
         super(OnTheFlyLexiconConfigSource, self).__init__()
         self.ttl = ttl
         self.domain = domain
+        self._overlay = local()
 
     def set_ttl(self, ttl):
         self.ttl = ttl
 
+    @contextmanager
+    def ttl_overlay(self, ttl):
+        # The TTL resolved while inside this block is only visible to the
+        # calling thread, so concurrent operations sharing one client can
+        # each use the TTL of their own record.
+        previous = getattr(self._overlay, 'ttl', None)
+        self._overlay.ttl = ttl
+        try:
+            yield self
+        finally:
+            self._overlay.ttl = previous
+
     def resolve(self, config_key):
         if config_key == "lexicon:ttl":
-            return self.ttl
+            ttl = getattr(self._overlay, 'ttl', None)
+            return self.ttl if ttl is None else ttl
         elif config_key == 'lexicon:domain':
             return self.domain
         # These two keys below are not used, because actions are handled in
@@ -467,5 +2196,13 @@ class RecordDeleteError(RecordUpdateError):
     pass
 
 
+class ApplyErrors(RuntimeError):
+    def __init__(self, errors):
+        self.errors = errors
+        msg = "{} change(s) failed: {}".format(
+            len(errors), '; '.join(str(e) for e in errors))
+        super(ApplyErrors, self).__init__(msg)
+
+
 class RecordCreateError(RecordUpdateError):
     pass
@@ -0,0 +1,844 @@
+#
+#
+#
+"""
+Benchmarks for octodns_lexicon
+
+    python octodns_lexicon_bench.py [--output FILE] [--sizes N,N]
+                                    [benchmark ...]
+
+Runs the named benchmarks (or all of them) and prints the results as JSON.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import re
+import resource
+import shlex
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import Counter, OrderedDict, namedtuple
+from threading import Thread
+
+from octodns.provider.plan import Plan
+from octodns.record import Record
+from octodns.zone import Zone
+
+import octodns_lexicon
+from octodns_lexicon import LexiconProvider, OnTheFlyLexiconConfigSource, \
+    RECORD_CODECS, RememberedIds, TxtCodec, ValuesCodec, ZoneIds
+from octodns_lexicon_stand_in import StandInDNSAPI, StandInLexiconProvider
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+class FakeLexiconProvider(object):
+    """In-memory lexicon provider, counting the calls made to it"""
+
+    def __init__(self, domain, records=()):
+        self.domain = domain
+        # Records in the order they were added, and by id, so that calls by
+        # identifier scale to large zones
+        self.records = OrderedDict()
+        self.records_by_id = {}
+        for record in records:
+            self._add(dict(record))
+        self.next_id = len(self.records)
+        self.calls = Counter()
+
+    def _add(self, record):
+        self.records[id(record)] = record
+        self.records_by_id.setdefault(record['id'], []).append(record)
+
+    def _remove(self, record):
+        del self.records[id(record)]
+        self.records_by_id[record['id']].remove(record)
+
+    def _matching(self, identifier=None, rtype=None, name=None, content=None):
+        records = self.records.values() if identifier is None \
+            else self.records_by_id.get(identifier, [])
+        return [r for r in records
+                if (rtype is None or r['type'] == rtype) and
+                (name is None or r['name'] == name.rstrip('.')) and
+                (content is None or r['content'] == content)]
+
+    def authenticate(self):
+        self.calls['authenticate'] += 1
+
+    def list_records(self, rtype=None, name=None, content=None):
+        self.calls['list_records'] += 1
+        return [dict(r) for r in self._matching(None, rtype, name, content)]
+
+    def create_record(self, rtype, name, content):
+        self.calls['create_record'] += 1
+        self.next_id += 1
+        self._add({'type': rtype, 'name': name.rstrip('.'), 'ttl': 300,
+                   'content': content, 'id': 'new-{}'.format(self.next_id)})
+        return True
+
+    def update_record(self, identifier=None, rtype=None, name=None,
+                      content=None):
+        self.calls['update_record'] += 1
+        self._matching(identifier)[0]['content'] = content
+        return True
+
+    def delete_record(self, identifier=None, rtype=None, name=None,
+                      content=None):
+        self.calls['delete_record'] += 1
+        for record in self._matching(identifier, rtype, name, content):
+            self._remove(record)
+        return True
+
+
+class FakeLexiconClient(object):
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.provider_name = 'fake'
+
+
+class FakeProviderLexiconProvider(LexiconProvider):
+    """LexiconProvider wrapping a FakeLexiconProvider"""
+
+    def __init__(self, id, lexicon_provider, **kwargs):
+        self.lexicon_provider = lexicon_provider
+        super(FakeProviderLexiconProvider, self).__init__(
+            id, lexicon_config={}, **kwargs)
+
+    def _create_client(self, zone_name):
+        return FakeLexiconClient(self.lexicon_provider), \
+            OnTheFlyLexiconConfigSource(zone_name)
+
+
+def _a_records(count, prefix='host'):
+    return [{'type': 'A', 'name': '{}{}'.format(prefix, i),
+             'data': '10.0.{}.{}'.format(i // 250, i % 250 + 1)}
+            for i in range(count)]
+
+
+@benchmark
+def bench_http_pool(records=50, changes=20):
+    """Connections opened per populate and per apply, with and without the
+    pooled HTTP sessions (http_pool_size)"""
+    results = []
+
+    for http_pool_size in (None, 4):
+        server = StandInDNSAPI('example.com', _a_records(records)).start()
+        provider = StandInLexiconProvider('bench', server.url,
+                                          http_pool_size=http_pool_size)
+        result = OrderedDict(http_pool_size=http_pool_size)
+
+        try:
+            existing = Zone('example.com.', [])
+            provider.populate(existing)
+            result['populate'] = {'requests': server.requests,
+                                  'connections': server.connections}
+
+            desired = Zone('example.com.', [])
+            for record in existing.records:
+                desired.add_record(record)
+            for i in range(changes):
+                desired.add_record(Record.new(desired, 'new{}'.format(i), {
+                    'type': 'A', 'ttl': 300, 'values': ['10.1.0.{}'.format(i)]
+                }), replace=True)
+
+            plan = provider.plan(desired)
+            server.reset_counters()
+            provider.apply(plan)
+            result['apply'] = {'changes': len(plan.changes),
+                               'requests': server.requests,
+                               'connections': server.connections}
+        finally:
+            server.stop()
+
+        results.append(result)
+
+    return results
+
+
+@benchmark
+def bench_stand_in_latency(records=60, latency=0.02, jitter=0.005):
+    """Wall time of applying a TTL change to every record of a zone, to a
+    stand-in API taking 20ms per request, serially, concurrently, with
+    pooled connections, and with every 10th request throttled"""
+    variants = OrderedDict([
+        ('serial', ({}, {})),
+        ('concurrent', ({'apply_max_workers': 8}, {})),
+        ('concurrent_pooled', ({'apply_max_workers': 8,
+                                'http_pool_size': 8}, {})),
+        ('concurrent_pooled_throttled', (
+            {'apply_max_workers': 8, 'http_pool_size': 8,
+             'rate_limit': {'rate': 1000, 'backoff': 0.05}},
+            {'throttle_every': 10, 'retry_after': 0})),
+    ])
+    results = OrderedDict()
+
+    for name, (provider_kwargs, server_kwargs) in variants.items():
+        server = StandInDNSAPI('example.com', _a_records(records),
+                               latency=latency, jitter=jitter,
+                               **server_kwargs).start()
+        provider = StandInLexiconProvider('bench', server.url,
+                                          **provider_kwargs)
+        try:
+            existing = Zone('example.com.', [])
+            provider.populate(existing)
+            desired = Zone('example.com.', [])
+            for record in existing.records:
+                desired.add_record(Record.new(desired, record.name, {
+                    'type': 'A', 'ttl': 600, 'values': record.values}))
+            plan = provider.plan(desired)
+
+            server.reset_counters()
+            start = time.time()
+            provider.apply(plan)
+            results[name] = OrderedDict([
+                ('changes', len(plan.changes)),
+                ('wall_seconds', round(time.time() - start, 3)),
+                ('requests', dict(server.requests_by_endpoint)),
+                ('throttled', server.throttled),
+                ('connections', server.connections),
+            ])
+        finally:
+            server.stop()
+
+    return results
+
+
+def _calls_with_zip_pairing(ids_by_value, values, ttl_changed):
+    # The number of calls _apply made before values were matched: sorted
+    # additions zipped with sorted deletions, updating only if all ids of
+    # the record were unique, else create and delete.
+    old, new = set(ids_by_value), set(values)
+    additions = sorted(new if ttl_changed else new - old)
+    deletions = sorted(old if ttl_changed else old - new)
+    all_unique = len(set(ids_by_value.values())) == len(ids_by_value)
+
+    pairs = list(zip(additions, deletions))
+    return sum(1 if all_unique else 2 for _ in pairs) + \
+        len(additions) - len(pairs) + len(deletions) - len(pairs)
+
+
+@benchmark
+def bench_pairing(size=50):
+    """Lexicon calls made applying typical edits of an A rrset of `size`
+    values, compared with zipping sorted additions and deletions"""
+    values = ['10.0.{}.{}'.format(i // 250, i % 250 + 1)
+              for i in range(size)]
+    unique_ids = {v: str(i) for i, v in enumerate(values)}
+    half_shared_ids = {v: str(i) if i < size // 2 else 'www'
+                       for i, v in enumerate(values)}
+    replaced = ['10.1.0.{}'.format(i + 1) for i in range(size // 5)]
+
+    scenarios = OrderedDict([
+        ('ttl_change', (unique_ids, values, 600)),
+        ('replace_fifth', (unique_ids, replaced + values[size // 5:], 300)),
+        ('grow_by_fifth', (unique_ids, values + replaced, 300)),
+        ('shrink_by_half', (unique_ids, values[:size // 2], 300)),
+        ('replace_fifth_partly_shared_ids',
+         (half_shared_ids, replaced + values[size // 5:], 300)),
+        ('ttl_change_partly_shared_ids', (half_shared_ids, values, 600)),
+    ])
+
+    results = OrderedDict()
+    for name, (ids_by_value, desired_values, ttl) in scenarios.items():
+        lexicon_provider = FakeLexiconProvider('example.com', [
+            {'type': 'A', 'name': 'www.example.com', 'ttl': 300,
+             'content': value, 'id': _id}
+            for value, _id in ids_by_value.items()])
+        provider = FakeProviderLexiconProvider('bench', lexicon_provider)
+
+        desired = Zone('example.com.', [])
+        desired.add_record(Record.new(desired, 'www', {
+            'type': 'A', 'ttl': ttl, 'values': desired_values}))
+
+        plan = provider.plan(desired)
+        lexicon_provider.calls.clear()
+        provider.apply(plan)
+
+        results[name] = OrderedDict([
+            ('calls', sum(lexicon_provider.calls.values())),
+            ('calls_zip_pairing', _calls_with_zip_pairing(
+                ids_by_value, desired_values, ttl != 300)),
+            ('by_operation', dict(lexicon_provider.calls)),
+        ])
+
+    return results
+
+
+def _synthetic_zone(records, values_per_record=2):
+    zone = Zone('example.com.', [])
+    for i in range(records):
+        zone.add_record(Record.new(zone, 'host{}'.format(i), {
+            'type': 'A', 'ttl': 300,
+            'values': ['10.{}.{}.{}'.format(i // 62500, i // 250 % 250, j)
+                       for j in range(1, values_per_record + 1)]}))
+    return zone
+
+
+class _ReprKeyedIds(ZoneIds):
+    """ZoneIds keyed as before: by repr of the record"""
+    _key = staticmethod(repr)
+
+
+@benchmark
+def bench_remembered_ids(records=50000):
+    """CPU time and memory of remembering the ids of a zone's values, and
+    looking them up as _apply does, keyed by repr or by name and type"""
+    zone_records = list(_synthetic_zone(records).records)
+    results = OrderedDict()
+
+    for name, ids_class in (('repr', _ReprKeyedIds),
+                            ('name_type', ZoneIds)):
+        tracemalloc.start()
+        start = time.process_time()
+        remembered_ids = ids_class()
+        for i, record in enumerate(zone_records):
+            for j, value in enumerate(record.values):
+                remembered_ids.remember(record, value, '{}-{}'.format(i, j))
+        remember_time = time.process_time() - start
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.process_time()
+        for record in zone_records:
+            for value in record.values:
+                remembered_ids.is_unique_id(
+                    record, remembered_ids.get(record, value))
+        lookup_time = time.process_time() - start
+
+        results[name] = OrderedDict([
+            ('remember_cpu_seconds', round(remember_time, 3)),
+            ('lookup_cpu_seconds', round(lookup_time, 3)),
+            ('memory_bytes', memory),
+        ])
+
+    return results
+
+
+class _ListedIds(_ReprKeyedIds):
+    """RememberedIds as before: all ids of a record in a list, which is
+    counted for every uniqueness check"""
+
+    def __init__(self):
+        super(_ListedIds, self).__init__()
+        self._listed_ids = {}
+
+    def remember(self, record, content, _id):
+        super(_ListedIds, self).remember(record, content, _id)
+        self._listed_ids.setdefault(self._key(record), []).append(_id)
+
+    def has_unique_ids(self, record):
+        all_ids = self._listed_ids.get(self._key(record), [])
+        return len(all_ids) == len(set(all_ids))
+
+    def is_unique_id(self, record, _id):
+        return self._listed_ids.get(self._key(record), []).count(_id) == 1
+
+
+@benchmark
+def bench_unique_ids(sizes=(100, 500, 2000)):
+    """CPU time of pairing and deleting values of big TXT and NS rrsets,
+    half of which change, with uniqueness counted from a list of all ids
+    or kept up to date as ids are remembered"""
+    zone = Zone('example.com.', [])
+    provider = FakeProviderLexiconProvider(
+        'bench', FakeLexiconProvider('example.com'))
+    results = OrderedDict()
+
+    for size in sizes:
+        for rtype, value in (('TXT', 'token-{}'), ('NS', 'ns{}.example.net.')):
+            existing = Record.new(zone, '', {
+                'type': rtype, 'ttl': 300,
+                'values': [value.format(i) for i in range(size)]})
+            desired = Record.new(zone, '', {
+                'type': rtype, 'ttl': 300,
+                'values': [value.format(i) for i in range(size // 2, size)] +
+                          [value.format(-i) for i in range(1, size // 2)]})
+            old_values = provider._rrset_for(existing)
+            new_values = provider._rrset_for(desired)
+            additions = new_values - old_values
+            deletions = old_values - new_values
+
+            result = results['{}_{}'.format(rtype, size)] = OrderedDict()
+            for name, ids_class in (('listed', _ListedIds),
+                                    ('incremental', ZoneIds)):
+                provider.remembered_ids = ids_class()
+                for i, lexicon_record in enumerate(sorted(old_values)):
+                    provider.remembered_ids.remember(
+                        existing, lexicon_record.content, str(i))
+
+                start = time.process_time()
+                _, _, deletes = provider._match_values(existing, additions,
+                                                       deletions)
+                for lexicon_record in deletes:
+                    provider.remembered_ids.is_unique_id(
+                        existing, provider.remembered_ids.get(
+                            existing, lexicon_record.content))
+                result[name] = round(time.process_time() - start, 4)
+
+    return results
+
+
+class _SyntheticZonesLexiconProvider(LexiconProvider):
+    """LexiconProvider listing a synthetic zone of A records for any zone"""
+
+    def __init__(self, id, records, **kwargs):
+        self.records = records
+        super(_SyntheticZonesLexiconProvider, self).__init__(
+            id, lexicon_config={}, **kwargs)
+
+    def _create_client(self, zone_name):
+        return FakeLexiconClient(FakeLexiconProvider(zone_name, [
+            {'type': 'A', 'name': 'host{}.{}'.format(i, zone_name),
+             'ttl': 300, 'content': '10.0.{}.{}'.format(i // 250, i % 250),
+             'id': str(i)}
+            for i in range(self.records)])), \
+            OnTheFlyLexiconConfigSource(zone_name)
+
+
+def _run_threads(target, args_per_thread):
+    workers = [Thread(target=target, args=(args,))
+               for args in args_per_thread]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+
+@benchmark
+def bench_parallel_populate(threads=32, zones_per_thread=8, records=500):
+    """Wall time of 32 threads populating synthetic zones of one provider,
+    and of them remembering the ids of such zones value by value, with the
+    remembered ids of all zones behind one lock or sharded"""
+    results = OrderedDict()
+
+    for name, shards in (('one_lock', 1),
+                         ('sharded', RememberedIds.SHARDS)):
+        provider = _SyntheticZonesLexiconProvider('bench', records)
+        provider.remembered_ids = RememberedIds(shards=shards)
+        zone_names = [['zone{}-{}.example.'.format(t, z)
+                       for z in range(zones_per_thread)]
+                      for t in range(threads)]
+        # Authenticated clients (and their listings) are built up front,
+        # so only populating the zones is timed
+        for names in zone_names:
+            for zone_name in names:
+                provider.clients.get(zone_name[:-1])
+
+        def populate(names):
+            for zone_name in names:
+                provider.populate(Zone(zone_name, []))
+
+        populate_time = _run_threads(populate, zone_names)
+
+        remembered_ids = RememberedIds(shards=shards)
+
+        def remember(names):
+            for zone_name in names:
+                record = Record.new(Zone(zone_name, []), 'www', {
+                    'type': 'A', 'ttl': 300, 'value': '10.0.0.1'})
+                for i in range(records * 4):
+                    remembered_ids.remember(record, str(i), i)
+                    remembered_ids.get(record, str(i))
+
+        remember_time = _run_threads(remember, zone_names)
+
+        results[name] = OrderedDict([
+            ('populate_wall_seconds', round(populate_time, 3)),
+            ('remember_wall_seconds', round(remember_time, 3)),
+            ('zones', provider.remembered_ids.stats()['zones']),
+        ])
+
+    return results
+
+
+class _NamedTupleLexiconRecord(
+        namedtuple('LexiconRecord', 'content ttl rtype name')):
+    """LexiconRecord as it was before: a namedtuple"""
+
+    def func_args(self):
+        return {k: getattr(self, k) for k in ['content', 'rtype', 'name']}
+
+
+def _namedtuple_rrset(octodns_record):
+    return {_NamedTupleLexiconRecord(content=c,
+                                     ttl=octodns_record.ttl,
+                                     rtype=octodns_record._type,
+                                     name=octodns_record.fqdn)
+            for c in octodns_record.values}
+
+
+@benchmark
+def bench_lexicon_records(records=1000, values_per_record=100):
+    """CPU time and memory of the lexicon records of a plan with 100k
+    values: building the rrsets, diffing and sorting them and taking
+    their call arguments, as namedtuples or as LexiconRecord"""
+    zone_records = list(
+        _synthetic_zone(records, values_per_record).records)
+    provider = FakeProviderLexiconProvider(
+        'bench', FakeLexiconProvider('example.com'))
+    results = OrderedDict()
+
+    for name, rrset in (('namedtuple', _namedtuple_rrset),
+                        ('slotted', provider._rrset_for)):
+        start = time.process_time()
+        rrsets = [rrset(record) for record in zone_records]
+        build_time = time.process_time() - start
+
+        del rrsets
+        tracemalloc.start()
+        rrsets = [rrset(record) for record in zone_records]
+        memory, _ = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        start = time.process_time()
+        for old_values in rrsets:
+            for lexicon_record in sorted(old_values - set()):
+                lexicon_record.func_args()
+        apply_time = time.process_time() - start
+
+        results[name] = OrderedDict([
+            ('values', sum(len(values) for values in rrsets)),
+            ('build_cpu_seconds', round(build_time, 3)),
+            ('apply_cpu_seconds', round(apply_time, 3)),
+            ('memory_bytes', memory),
+        ])
+
+    return results
+
+
+@benchmark
+def bench_content_parsing(records=100000):
+    """Lexicon records of MX, SRV and CAA values parsed per second by
+    their codecs, splitting contents with shlex or with split_content"""
+    contents = OrderedDict([
+        ('MX', '{} mail{}.example.com.'),
+        ('SRV', '{} 1 443 sip{}.example.com.'),
+        ('CAA', '0 issue "ca{}.example.net; account={}"'),
+    ])
+    results = OrderedDict()
+
+    for name, split in (('shlex', shlex.split),
+                        ('split_content', octodns_lexicon.split_content)):
+        result = results[name] = OrderedDict()
+        original, octodns_lexicon.split_content = \
+            octodns_lexicon.split_content, split
+        try:
+            for rtype, content in contents.items():
+                lexicon_records = [
+                    {'content': content.format(i % 100, i)}
+                    for i in range(records)]
+                start = time.process_time()
+                RECORD_CODECS[rtype].parse(lexicon_records)
+                result[rtype] = int(records / (time.process_time() - start))
+        finally:
+            octodns_lexicon.split_content = original
+
+    return results
+
+
+class _RegexValuesCodec(ValuesCodec):
+    """Values codec as it was before, for A, AAAA, NS and TXT alike"""
+
+    def parse(self, lexicon_records):
+        return {'values': [re.sub(';', r'\;', r['content'])
+                           for r in lexicon_records]}
+
+
+@benchmark
+def bench_txt_values(records=20000):
+    """CPU time of parsing and formatting the values of a zone of DKIM and
+    SPF records (with DKIM keys listed in chunks) and as many A records,
+    and how many of the formatted TXT values match the content their id
+    is remembered by, with the values codec as before or TxtCodec"""
+    zone = Zone('example.com.', [])
+    dkim = 'v=DKIM1; k=rsa; p=' + 'MIIBIjANBgkqhkiG9w0BAQEFAAOCAQ8A' * 12
+    spf = 'v=spf1 ip4:192.0.2.0/24 include:_spf.example.net ~all'
+
+    def listing():
+        return [
+            [{'content': '"{}" "{}"'.format(dkim[:255], dkim[255:])}]
+            if i % 2 else [{'content': spf}]
+            for i in range(records)], \
+            [[{'content': '10.0.{}.{}'.format(i // 250, i % 250)}]
+             for i in range(records)]
+
+    results = OrderedDict()
+    for name, txt_codec, values_codec in (
+            ('regex', _RegexValuesCodec(), _RegexValuesCodec()),
+            ('txt_codec', TxtCodec(), ValuesCodec())):
+        txt_listing, a_listing = listing()
+
+        start = time.process_time()
+        txt_data = [txt_codec.parse(r) for r in txt_listing]
+        for lexicon_records in a_listing:
+            values_codec.parse(lexicon_records)
+        parse_time = time.process_time() - start
+
+        txt_records = [Record.new(zone, 'txt{}'.format(i), dict(
+            data, type='TXT', ttl=300)) for i, data in enumerate(txt_data)]
+        start = time.process_time()
+        formatted = [txt_codec.format(r) for r in txt_records]
+        format_time = time.process_time() - start
+
+        results[name] = OrderedDict([
+            ('parse_cpu_seconds', round(parse_time, 3)),
+            ('format_cpu_seconds', round(format_time, 3)),
+            ('ids_matched', sum(
+                contents == [r['content'] for r in lexicon_records]
+                for contents, lexicon_records
+                in zip(formatted, txt_listing))),
+        ])
+
+    return results
+
+
+class _SyntheticListingProvider(object):
+    """Lexicon provider listing a synthetic zone, made anew for each listing
+    so that only populate holds on to it"""
+
+    def __init__(self, values):
+        self.values = values
+
+    def authenticate(self):
+        pass
+
+    def list_records(self, rtype=None, name=None, content=None):
+        listing = []
+        for i in range(self.values):
+            name = 'host{}.example.com'.format(i // 4)
+            if i % 4 < 2:
+                listing.append({
+                    'type': 'A', 'name': name, 'ttl': 300, 'id': str(i),
+                    'content': '10.{}.{}.{}'.format(
+                        i // 65536 % 256, i // 256 % 256, i % 256)})
+            elif i % 4 == 2:
+                listing.append({
+                    'type': 'MX', 'name': name, 'ttl': 300, 'id': str(i),
+                    'content': '10 mx{}.example.net.'.format(i)})
+            else:
+                listing.append({
+                    'type': 'TXT', 'name': name, 'ttl': 300, 'id': str(i),
+                    'content': 'v=spf1 ip4:10.0.0.{} ~all'.format(i % 256)})
+        return listing
+
+
+def _populate_in_child(values, streaming_populate, results):
+    provider = FakeProviderLexiconProvider(
+        'bench', _SyntheticListingProvider(values),
+        streaming_populate=streaming_populate)
+    zone = Zone('example.com.', [])
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.process_time()
+    provider.populate(zone)
+    results.put(OrderedDict([
+        ('records', len(zone.records)),
+        ('cpu_seconds', round(time.process_time() - start, 3)),
+        # kilobytes on linux
+        ('peak_rss_growth_kb', resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss - rss_before),
+    ]))
+
+
+@benchmark
+def bench_streaming_populate(values=500000):
+    """Peak RSS growth and CPU time of populating a zone of 500k values (A,
+    MX and TXT records of 125k names) with and without streaming_populate,
+    each in a process of its own"""
+    results = OrderedDict()
+
+    for name, streaming_populate in (('grouped', False),
+                                     ('streaming', True)):
+        queue = multiprocessing.Queue()
+        child = multiprocessing.Process(
+            target=_populate_in_child,
+            args=(values, streaming_populate, queue))
+        child.start()
+        results[name] = queue.get()
+        child.join()
+
+    return results
+
+
+# Realistic mix of record types, by the remainder of the value index
+# divided by 20, and the name and content of each value of that type
+_REALISTIC_MIX = [('A', 'host{}', '10.{}.{}.{}')] * 10 + \
+    [('AAAA', 'host{}', '2001:db8::{:x}:{:x}:{:x}')] * 3 + \
+    [('CNAME', 'alias{}', 'host{}.example.com.')] * 3 + \
+    [('MX', 'mail{}', '10 mx{}.example.net.'),
+     ('TXT', 'host{}', 'v=spf1 ip4:10.0.0.{} -all'),
+     ('TXT', '_verify{}', 'verification={}'),
+     ('SRV', '_sip._tcp.sip{}', '10 20 5060 sip{}.example.net.')]
+
+
+def _realistic_listing(values):
+    listing = []
+    for i in range(values):
+        rtype, name, content = _REALISTIC_MIX[i % len(_REALISTIC_MIX)]
+        if rtype in ('A', 'AAAA'):
+            content = content.format(i // 65536 % 256, i // 256 % 256,
+                                     i % 256)
+        else:
+            content = content.format(i % 256)
+        listing.append({'type': rtype, 'name': '{}.example.com'.format(
+            name.format(i)), 'ttl': 300, 'content': content,
+            'id': str(i)})
+    return listing
+
+
+def _desired_zone(existing, new_records):
+    """The existing zone with one in 100 records deleted, one in 100 A
+    records given another value, one in 100 records given another TTL,
+    and new_records A records added"""
+    desired = Zone(existing.name, [])
+    for i, record in enumerate(sorted(existing.records,
+                                      key=lambda r: (r.name, r._type))):
+        data = record.data
+        if i % 100 == 0:
+            continue
+        elif i % 100 == 1 and record._type == 'A':
+            data['values'] = ['192.0.2.{}'.format(i % 256)]
+        elif i % 100 == 2:
+            data['ttl'] = 600
+        desired.add_record(Record.new(desired, record.name,
+                                      dict(data, type=record._type)))
+    for i in range(new_records):
+        desired.add_record(Record.new(desired, 'new{}'.format(i), {
+            'type': 'A', 'ttl': 300, 'value': '198.51.100.{}'.format(
+                i % 256)}))
+    return desired
+
+
+def _scale_in_child(values, trace_memory, results):
+    listing = _realistic_listing(values)
+    lexicon_provider = FakeLexiconProvider('example.com', listing)
+    provider = FakeProviderLexiconProvider('bench', lexicon_provider)
+    existing = Zone('example.com.', [])
+    FakeProviderLexiconProvider('desired', FakeLexiconProvider(
+        'example.com', listing)).populate(existing)
+    desired = _desired_zone(existing, values // 100)
+    del listing, existing
+
+    phases = OrderedDict()
+    if trace_memory:
+        tracemalloc.start()
+
+    def phase(name, func, *args):
+        calls_before = sum(lexicon_provider.calls.values())
+        start_cpu, start = time.process_time(), time.time()
+        if trace_memory:
+            tracemalloc.reset_peak()
+            memory_before, _ = tracemalloc.get_traced_memory()
+        result = func(*args)
+        phases[name] = OrderedDict([
+            ('cpu_seconds', round(time.process_time() - start_cpu, 3)),
+            ('wall_seconds', round(time.time() - start, 3)),
+            ('api_calls', sum(lexicon_provider.calls.values()) -
+             calls_before),
+        ])
+        if trace_memory:
+            phases[name]['peak_memory_bytes'] = \
+                tracemalloc.get_traced_memory()[1] - memory_before
+        return result
+
+    existing = Zone('example.com.', [])
+    exists = phase('populate', provider.populate, existing, True, True)
+    plan = phase('plan', lambda: Plan(
+        existing, desired, existing.changes(desired, provider), exists))
+    phase('apply', provider.apply, plan)
+
+    results.put(OrderedDict([
+        ('records', len(existing.records)),
+        ('changes', len(plan.changes)),
+        ('phases', phases),
+    ]))
+
+
+@benchmark
+def bench_scaling(sizes=(1000, 10000, 100000)):
+    """CPU and wall time, API calls and peak memory allocated by populating,
+    planning and applying zones of realistically mixed record types, where
+    about 3% of the records change. Each size is run in a process of its
+    own, and then again tracing memory, which slows it down."""
+    results = OrderedDict()
+
+    for size in sizes:
+        runs = []
+        for trace_memory in (False, True):
+            queue = multiprocessing.Queue()
+            child = multiprocessing.Process(
+                target=_scale_in_child, args=(size, trace_memory, queue))
+            child.start()
+            runs.append(queue.get())
+            child.join()
+
+        timed, traced = runs
+        for name, phase in timed['phases'].items():
+            phase['peak_memory_bytes'] = \
+                traced['phases'][name]['peak_memory_bytes']
+        results[size] = timed
+
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.STDOUT,
+            cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(
+        description='Runs the named benchmarks (or all of them) and prints '
+        'the results as JSON.')
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help='one of: {}'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--output', help='also write the results to this '
+                        'file, along with the commit and python version '
+                        'they were measured with, to compare runs')
+    parser.add_argument('--sizes', type=lambda sizes: tuple(
+        int(size) for size in sizes.split(',')),
+        help='zone sizes of the scaling benchmark, e.g. 1000,1000000')
+    args = parser.parse_args(argv)
+
+    unknown = set(args.benchmarks) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(unknown)))
+
+    logging.basicConfig(level=logging.WARNING)
+    results = OrderedDict()
+    for name in args.benchmarks or list(BENCHMARKS):
+        kwargs = {'sizes': args.sizes} \
+            if name == 'scaling' and args.sizes else {}
+        results[name] = BENCHMARKS[name](**kwargs)
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(OrderedDict([
+                ('commit', _commit()),
+                ('python', platform.python_version()),
+                ('measured_at', time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                              time.gmtime())),
+                ('results', results),
+            ]), fh, indent=2)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
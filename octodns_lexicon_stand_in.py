@@ -0,0 +1,212 @@
+#
+#
+#
+"""
+Local stand-in for a DNS API, for the tests and benchmarks of
+octodns_lexicon to run the provider against real HTTP requests
+"""
+
+import json
+import random
+import time
+from collections import Counter, OrderedDict
+from threading import Lock, Thread
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qs, urlsplit
+except ImportError:  # pragma: no cover
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qs, urlsplit
+
+from octodns_lexicon import LexiconProvider, ProviderProxy
+
+
+class StandInDNSAPI(ThreadingMixIn, HTTPServer):
+    """
+    Local stand-in for the DigitalOcean DNS API, just enough of it for the
+    lexicon digitalocean provider to populate and apply a zone.
+
+    latency: seconds every request takes, give or take up to jitter seconds
+    throttle_every: if set, every so many requests are answered with 429
+            Too Many Requests, with a Retry-After of retry_after seconds
+    per_page: if set, records are listed in pages of this many, linked by
+            links.pages.next, unless the client asks for per_page itself
+
+    Counts the requests it serves by method and endpoint, the connections
+    they arrived on, the requests throttled and the latency added.
+    """
+    daemon_threads = True
+
+    def __init__(self, domain, records=(), latency=0, jitter=0,
+                 throttle_every=None, retry_after=0, per_page=None, seed=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _StandInHandler)
+        self.lock = Lock()
+        self.domain = domain
+        self.records = OrderedDict()
+        self.next_id = 1
+        self.latency = latency
+        self.jitter = jitter
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.per_page = per_page
+        self.random = random.Random(seed)
+        self.reset_counters()
+
+        for record in records:
+            self.add_record(**record)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{}/v2'.format(self.server_address[1])
+
+    def add_record(self, type, name, data, ttl=3600):
+        with self.lock:
+            record = {'id': self.next_id, 'type': type, 'name': name,
+                      'data': data, 'ttl': ttl}
+            self.records[self.next_id] = record
+            self.next_id += 1
+        return record
+
+    def reset_counters(self):
+        with self.lock:
+            self.connections = 0
+            self.requests = 0
+            self.requests_by_endpoint = Counter()
+            self.throttled = 0
+            self.latency_added = 0
+
+    def start(self):
+        thread = Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def handle_api_request(self, method, path, body):
+        """Returns the status, payload and headers of the response"""
+        url = urlsplit(path)
+        parts = url.path.strip('/').split('/')
+        endpoint = '{} {}'.format(
+            method, ('domain', 'records', 'records/ID')[
+                min(max(len(parts) - 3, 0), 2)])
+
+        with self.lock:
+            self.requests += 1
+            self.requests_by_endpoint[endpoint] += 1
+            throttle = self.throttle_every and \
+                self.requests % self.throttle_every == 0
+            if throttle:
+                self.throttled += 1
+            delay = max(0, self.latency +
+                        self.random.uniform(-self.jitter, self.jitter))
+            self.latency_added += delay
+
+        # Requests wait for their latency in parallel
+        time.sleep(delay)
+
+        if throttle:
+            return 429, {'id': 'too_many_requests'}, \
+                {'Retry-After': str(self.retry_after)}
+
+        # v2 / domains / <domain> [/ records [/ <id>]]
+        if parts[:2] != ['v2', 'domains'] or len(parts) < 3 or \
+                parts[2] != self.domain:
+            return 404, {'id': 'not_found'}, {}
+
+        if len(parts) == 3:
+            return 200, {'domain': {'name': self.domain}}, {}
+
+        if len(parts) == 4 and method == 'GET':
+            return 200, self._list_page(url), {}
+
+        if len(parts) == 4 and method == 'POST':
+            return 201, {'domain_record': self.add_record(
+                body['type'], body['name'], body['data'], body['ttl'])}, {}
+
+        with self.lock:
+            record = self.records.get(int(parts[4]))
+            if record is None:
+                return 404, {'id': 'not_found'}, {}
+            if method == 'DELETE':
+                del self.records[record['id']]
+                return 204, None, {}
+            record.update(body)
+            return 200, {'domain_record': record}, {}
+
+    def _list_page(self, url):
+        query = parse_qs(url.query)
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', [self.per_page or 0])[0])
+
+        with self.lock:
+            records = list(self.records.values())
+
+        links = {}
+        if per_page:
+            pages = max(1, (len(records) + per_page - 1) // per_page)
+            if page < pages:
+                links['pages'] = {
+                    'next': '{}/domains/{}/records?page={}&per_page={}'
+                    .format(self.url, self.domain, page + 1, per_page)}
+            records = records[(page - 1) * per_page:page * per_page]
+
+        return {'domain_records': records, 'links': links,
+                'meta': {'total': len(self.records)}}
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _handle(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or '{}')
+
+        status, payload, headers = self.server.handle_api_request(
+            self.command, self.path, body)
+
+        data = b'' if payload is None else json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+
+class StandInLexiconProvider(LexiconProvider):
+    """LexiconProvider wrapping lexicon's digitalocean provider, pointed at
+    a StandInDNSAPI"""
+
+    def __init__(self, id, api_url, **kwargs):
+        self.api_url = api_url
+        lexicon_config = {'provider_name': 'digitalocean',
+                          'digitalocean': {'auth_token': 'bench'}}
+        super(StandInLexiconProvider, self).__init__(
+            id, lexicon_config=lexicon_config, **kwargs)
+
+    def _create_client(self, zone_name):
+        lexicon_client, dynamic_config = super(
+            StandInLexiconProvider, self)._create_client(zone_name)
+        # Past any rate limiting or rrset proxy of the lexicon provider
+        lexicon_provider = lexicon_client.provider
+        while isinstance(lexicon_provider, ProviderProxy):
+            lexicon_provider = lexicon_provider.wrapped
+        lexicon_provider.api_endpoint = self.api_url
+        return lexicon_client, dynamic_config
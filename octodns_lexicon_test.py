@@ -1,15 +1,32 @@
+import json
+import os
+import pstats
+import shlex
+import shutil
+import sys
+import tempfile
+from threading import Event, Thread
+from time import sleep
 from unittest import TestCase
 
 import mock
+import requests
+import requests_mock
 from mock import Mock
 
 from octodns.provider.plan import Plan
 from octodns.record import Record, Create, Delete, Update
 from octodns.zone import Zone
 
+import octodns_lexicon
 from octodns_lexicon import \
     LexiconProvider, OnTheFlyLexiconConfigSource, RecordUpdateError, \
-    RecordCreateError, RecordDeleteError, RememberedIds
+    RecordCreateError, RecordDeleteError, RememberedIds, ApplyErrors, \
+    HttpSessionPool, PooledRequests, PooledProvider, POOLED_REQUESTS, \
+    ZoneListingCache, RateLimiter, RateLimitedProvider, PowerDNSRRSets, \
+    MemoizedListings, LexiconRecord, \
+    ApiMetrics, MeteredProvider, ZoneProfiler, TxtCodec, split_content
+from octodns_lexicon_stand_in import StandInDNSAPI, StandInLexiconProvider
 
 LEXICON_DATA = [
     {'type': 'A', 'name': '@.blodapels.in', 'ttl': 10800, 'content':
@@ -125,6 +142,79 @@ class TestLexiconProvider(TestCase):
         self.assertTrue(mock_provider.called, "authenticate was called")
         mock_auth.assert_called()
 
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_streaming_populate(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = \
+            [dict(r) for r in reversed(LEXICON_DATA)]
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   streaming_populate=True)
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        exists = provider.populate(zone=zone)
+
+        # Then
+        self.assertTrue(exists)
+        self.assertEqual(zone.records, set(OCTODNS_DATA))
+        mx = next(r for r in zone.records if r._type == 'MX')
+        self.assertEqual(
+            provider.remembered_ids.get(mx, '50 fb.mail.example.com.'), '@')
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_metrics_hook(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = \
+            [dict(r) for r in LEXICON_DATA]
+        mock_provider.return_value.create_record.return_value = True
+        summaries = []
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   metrics_hook=summaries.append)
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+        provider._apply(Plan(zone, zone, [Create(OCTODNS_DATA[0])], True))
+
+        # Then
+        populate, apply = summaries
+        self.assertEqual((populate['provider'], populate['operation'],
+                          populate['zone']),
+                         ('unittests', 'populate', 'blodapels.in.'))
+        self.assertEqual(list(populate['phases']), [
+            'create_client', 'authenticate', 'list_records', 'harmonize',
+            'parse_values', 'record_new', 'add_record'])
+        self.assertEqual(populate['phases']['record_new']['calls'],
+                         len(OCTODNS_DATA))
+        self.assertGreaterEqual(populate['seconds'], sum(
+            p['seconds'] for p in populate['phases'].values()))
+
+        self.assertEqual(apply['operation'], '_apply')
+        self.assertEqual(list(apply['phases']), ['create_record'],
+                         "the client of populate is reused")
+        self.assertEqual(apply['phases']['create_record']['calls'], 1)
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_metrics_hook_by_path(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.side_effect = \
+            requests.ConnectionError('unreachable')
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   metrics_hook='json.loads')
+
+        # When
+        with mock.patch.object(provider.log, 'warning') as warning:
+            with self.assertRaises(requests.ConnectionError):
+                provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        self.assertIs(provider.metrics_hook, json.loads)
+        self.assertEqual(warning.call_args[0][:2],
+                         ('metrics_hook: failed on %s: %s', 'blodapels.in.'))
+
     @mock.patch('lexicon.providers.gandi.Provider')
     def test_populate_with_relative_name(self, mock_provider):
         # Given
@@ -179,6 +269,161 @@ class TestLexiconProvider(TestCase):
         self.assertEqual(set(zone.records.pop().values),
                          wanted_record_values, "out of zone record parsed OK")
 
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_client_reused_for_populate_and_apply(self, mock_provider):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+        zone = Zone("blodapels.in.", [])
+        mock_provider.return_value.list_records.return_value = iter([])
+
+        # When
+        provider.populate(zone)
+        provider._apply(Plan(zone, zone, [Create(OCTODNS_DATA[0])], True))
+
+        # Then
+        self.assertEqual(mock_provider.call_count, 1,
+                         "one lexicon provider per zone")
+        mock_provider.return_value.authenticate.assert_called_once_with()
+
+    @mock.patch('octodns_lexicon.time')
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_client_expires(self, mock_provider, mock_time):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   client_max_age=60)
+
+        # When
+        mock_time.return_value = 1000
+        first, _ = provider.clients.get("blodapels.in")
+        mock_time.return_value = 1059
+        second, _ = provider.clients.get("blodapels.in")
+        mock_time.return_value = 1060
+        third, _ = provider.clients.get("blodapels.in")
+        other_zone, _ = provider.clients.get("example.com")
+
+        # Then
+        self.assertIs(first, second, "client reused until max age")
+        self.assertIsNot(second, third, "client recreated after max age")
+        self.assertIsNot(third, other_zone, "clients are kept per zone")
+        self.assertEqual(
+            mock_provider.return_value.authenticate.call_count, 3)
+
+    def test_http_session_pool(self):
+        # Given
+        pool = HttpSessionPool(pool_size=2)
+        closing_pool = HttpSessionPool(pool_size=2, keep_alive=False)
+
+        # When
+        session = pool.session_for('https://api.example.com/v1/zones')
+        same_host = pool.session_for('https://api.example.com/v1/records')
+        other_host = pool.session_for('https://dns.example.net/v1/zones')
+        closing = closing_pool.session_for('https://api.example.com/v1')
+
+        # Then
+        self.assertIs(session, same_host, "one session per API host")
+        self.assertIsNot(session, other_host)
+        self.assertEqual(
+            session.get_adapter('https://api.example.com/')._pool_maxsize, 2)
+        self.assertNotEqual(session.headers.get('Connection'), 'close')
+        self.assertEqual(closing.headers['Connection'], 'close')
+
+    def test_http_session_pool_keeps_no_cookies(self):
+        # Given
+        pool = HttpSessionPool()
+        url = 'https://api.example.com/v1/login'
+
+        # When
+        with requests_mock.Mocker() as m:
+            m.get(url, headers={'Set-Cookie': 'session=secret; Path=/'})
+            pool.request('GET', url)
+            m.get(url, text='again')
+            pool.request('GET', url)
+
+        # Then
+        self.assertEqual(len(pool.session_for(url).cookies), 0)
+        self.assertNotIn('Cookie', m.last_request.headers)
+
+    def test_pooled_requests(self):
+        # Given
+        pooled = PooledRequests()
+        pool = HttpSessionPool()
+        url = 'https://api.example.com/v1/records'
+
+        # When
+        with requests_mock.Mocker() as m:
+            for method in ('GET', 'POST', 'PUT', 'PATCH', 'DELETE'):
+                m.register_uri(method, url, text=method)
+            with mock.patch.object(pool, 'request',
+                                   wraps=pool.request) as pool_request:
+                with pooled.using(pool):
+                    responses = [pooled.get(url), pooled.post(url, data='{}'),
+                                 pooled.put(url), pooled.patch(url),
+                                 pooled.delete(url)]
+                unpooled = pooled.request('GET', url)
+
+        # Then
+        self.assertEqual([r.text for r in responses + [unpooled]],
+                         ['GET', 'POST', 'PUT', 'PATCH', 'DELETE', 'GET'])
+        self.assertEqual(pool_request.call_count, 5,
+                         "requests are pooled only while a pool is in use")
+        self.assertIsNone(pooled.pool)
+        self.assertIs(pooled.HTTPError, requests.HTTPError,
+                      "everything else is looked up in requests")
+
+    @mock.patch('lexicon.providers.gandi.Provider.authenticate')
+    def test_http_pool_scoped_to_lexicon_provider(self, mock_auth):
+        # Given
+        gandi_module = sys.modules['lexicon.providers.gandi']
+        pools_in_use = []
+        mock_auth.side_effect = \
+            lambda: pools_in_use.append(gandi_module.requests.pool)
+        providers = [
+            LexiconProvider(id="a", lexicon_config=lexicon_config,
+                            http_pool_size=2),
+            LexiconProvider(id="b", lexicon_config=lexicon_config,
+                            http_pool_size=50, http_keep_alive=False),
+            LexiconProvider(id="c", lexicon_config=lexicon_config)]
+
+        # When
+        clients = [p.clients.get("blodapels.in")[0] for p in providers]
+        installed = gandi_module.requests
+        POOLED_REQUESTS.uninstall(clients[0].provider.wrapped)
+
+        # Then
+        self.assertIs(installed, POOLED_REQUESTS)
+        self.assertEqual(pools_in_use, [providers[0].http_sessions,
+                                        providers[1].http_sessions, None])
+        self.assertIsInstance(clients[0].provider, PooledProvider)
+        self.assertNotIsInstance(clients[2].provider, PooledProvider)
+        self.assertIs(gandi_module.requests, requests, "uninstalled")
+
+    def test_pooled_provider(self):
+        # Given
+        pool = HttpSessionPool()
+        lexicon_provider = Mock()
+        pools_in_use = []
+        for method in ('list_records', 'create_record', 'update_record',
+                       'delete_record', 'replace_rrset'):
+            getattr(lexicon_provider, method).side_effect = \
+                lambda *args, **kwargs: pools_in_use.append(
+                    POOLED_REQUESTS.pool)
+        pooled = PooledProvider(lexicon_provider, pool)
+
+        # When
+        pooled.list_records('A')
+        pooled.create_record('A', 'www', '10.0.0.1')
+        pooled.update_record('1', 'A', 'www', '10.0.0.2')
+        pooled.delete_record('1')
+        pooled.replace_rrset(rtype='A', name='www', contents=[])
+
+        # Then
+        self.assertEqual(pools_in_use, [pool] * 5)
+        lexicon_provider.update_record.assert_called_once_with(
+            '1', 'A', 'www', '10.0.0.2')
+        self.assertIsNone(POOLED_REQUESTS.pool)
+
     def test_invalid_config(self):
         with self.assertRaises(AttributeError):
             provider = LexiconProvider(id="unittests", lexicon_config={})
@@ -205,6 +450,290 @@ class TestLexiconProvider(TestCase):
         self.assertEqual(remembered_ids.get_all_ids(record_a), ['@'])
         self.assertEqual(remembered_ids.get_all_ids(record_b), [])
 
+    def test_remembered_ids_by_zone_name_and_type(self):
+        # Given
+        remembered_ids = RememberedIds()
+        populated = Record.new(ZONE, 'www', {'ttl': 30, 'type': 'A',
+                                             'values': ['192.0.2.1']})
+        planned = Record.new(ZONE, 'www', {'ttl': 60, 'type': 'A',
+                                           'values': ['192.0.2.2']})
+        other_type = Record.new(ZONE, 'www', {'ttl': 30, 'type': 'AAAA',
+                                              'values': ['2001:db8::1']})
+
+        # When
+        remembered_ids.remember(populated, '192.0.2.1', '1')
+
+        # Then
+        self.assertEqual(remembered_ids.get(planned, '192.0.2.1'), '1',
+                         "ids do not depend on the values of the record")
+        self.assertEqual(remembered_ids.get_all_ids(other_type), [])
+
+    def test_remembered_ids_uniqueness(self):
+        # Given
+        remembered_ids = RememberedIds()
+        record = Record.new(ZONE, 'www', {'ttl': 30, 'type': 'A', 'values': [
+            '192.0.2.1', '192.0.2.2', '192.0.2.3']})
+
+        # When
+        remembered_ids.remember(record, '192.0.2.1', '1')
+        remembered_ids.remember(record, '192.0.2.2', 'www')
+        unique_before = remembered_ids.has_unique_ids(record)
+        remembered_ids.remember(record, '192.0.2.3', 'www')
+
+        # Then
+        self.assertTrue(unique_before)
+        self.assertFalse(remembered_ids.has_unique_ids(record))
+        self.assertTrue(remembered_ids.is_unique_id(record, '1'))
+        self.assertFalse(remembered_ids.is_unique_id(record, 'www'))
+        self.assertFalse(remembered_ids.is_unique_id(record, None))
+
+    def test_lexicon_record(self):
+        # Given
+        record = LexiconRecord('192.0.2.1', 300, 'A', 'www.blodapels.in.')
+
+        # Then
+        self.assertEqual(record, LexiconRecord('192.0.2.1', 300, 'A',
+                                               'www.blodapels.in.'))
+        self.assertNotEqual(record, LexiconRecord('192.0.2.1', 600, 'A',
+                                                  'www.blodapels.in.'))
+        self.assertNotEqual(record, ('192.0.2.1', 300, 'A',
+                                     'www.blodapels.in.'))
+        self.assertLess(record, LexiconRecord('192.0.2.2', 300, 'A',
+                                              'www.blodapels.in.'))
+        self.assertLess(record, LexiconRecord('192.0.2.1', 600, 'A',
+                                              'www.blodapels.in.'))
+        self.assertEqual(record.func_args(), {
+            'content': '192.0.2.1', 'rtype': 'A',
+            'name': 'www.blodapels.in.'})
+        self.assertEqual(record.to_list_format(), {
+            'content': '192.0.2.1', 'ttl': 300, 'type': 'A',
+            'name': 'www.blodapels.in.'})
+        self.assertEqual(repr(record), "LexiconRecord(content='192.0.2.1', "
+                         "ttl=300, rtype='A', name='www.blodapels.in.')")
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_populate_replaces_remembered_ids(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.side_effect = \
+            lambda *args: [dict(r) for r in LEXICON_DATA]
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+        zone = Zone("blodapels.in.", [])
+        provider.populate(zone)
+        stats_before = provider.remembered_ids.stats()
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        www = next(r for r in zone.records if r.name == 'www')
+        self.assertEqual(provider.remembered_ids.get_all_ids(www), ['www'])
+        self.assertTrue(provider.remembered_ids.has_unique_ids(www))
+        self.assertEqual(provider.remembered_ids.stats(), stats_before)
+        self.assertEqual((stats_before['zones'], stats_before['entries']),
+                         (1, len(LEXICON_DATA) - 1))
+
+    def test_remembered_ids_evicted_least_recently_used(self):
+        # Given
+        remembered_ids = RememberedIds(max_zones=2)
+        records = [Record.new(Zone(name, []), 'www', {
+            'ttl': 30, 'type': 'A', 'value': '192.0.2.1'})
+            for name in ('a.dev.', 'b.dev.', 'c.dev.')]
+
+        # When
+        remembered_ids.remember(records[0], '192.0.2.1', '1')
+        remembered_ids.remember(records[1], '192.0.2.1', '2')
+        remembered_ids.touch('a.dev.')
+        remembered_ids.remember(records[2], '192.0.2.1', '3')
+
+        # Then
+        self.assertEqual([r.zone.name in remembered_ids for r in records],
+                         [True, False, True])
+        self.assertEqual(remembered_ids.stats()['evictions'], 1)
+
+    def test_remembered_ids_of_zones_remembered_in_parallel(self):
+        # Given
+        remembered_ids = RememberedIds(shards=4)
+        records = [Record.new(Zone('zone{}.dev.'.format(i), []), 'www', {
+            'ttl': 30, 'type': 'A', 'value': '192.0.2.1'})
+            for i in range(16)]
+
+        def remember(record):
+            for i in range(100):
+                remembered_ids.remember(record, str(i), i)
+
+        # When
+        threads = [Thread(target=remember, args=(r,)) for r in records]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Then
+        stats = remembered_ids.stats()
+        self.assertEqual((stats['zones'], stats['entries']), (16, 1600))
+        self.assertTrue(all(remembered_ids.get(r, '99') == 99
+                            for r in records))
+
+    def test_remembered_ids_evicted_by_size(self):
+        # Given
+        remembered_ids = RememberedIds(max_bytes=1000)
+        record = Record.new(Zone('a.dev.', []), 'www', {
+            'ttl': 30, 'type': 'A', 'value': '192.0.2.1'})
+        other = Record.new(Zone('b.dev.', []), 'www', {
+            'ttl': 30, 'type': 'A', 'value': '192.0.2.1'})
+
+        # When
+        remembered_ids.remember(record, '192.0.2.1', '1')
+        remembered_ids.remember(other, '192.0.2.1', '1')
+        for i in range(10):
+            remembered_ids.remember(other, '192.0.2.{}'.format(i), str(i))
+
+        # Then
+        stats = remembered_ids.stats()
+        self.assertEqual((stats['zones'], stats['entries']), (1, 11),
+                         "the zone used most recently is always kept")
+        self.assertIsNone(remembered_ids.get(record, '192.0.2.1'))
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_apply_lists_forgotten_zone_anew(self, mock_provider):
+        # Given
+        provider_mock = mock_provider.return_value
+        provider_mock.list_records.side_effect = \
+            lambda *args: [dict(r) for r in LEXICON_DATA]
+        provider_mock.update_record.return_value = True
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   remembered_ids={'max_zones': 1})
+        existing = Zone("blodapels.in.", [])
+        provider.populate(existing)
+        provider.populate(Zone("example.com.", []))
+        www = next(r for r in existing.records if r.name == 'www')
+        desired = Record.new(existing, 'www', {
+            'type': 'CNAME', 'ttl': 10800, 'value': 'www.example.com.'})
+
+        # When
+        provider._apply(Plan(existing, existing, [Update(www, desired)],
+                             True))
+
+        # Then
+        self.assertEqual(provider_mock.list_records.call_count, 3)
+        provider_mock.update_record.assert_called_once_with(
+            identifier='www', content='www.example.com.', rtype='CNAME',
+            name='www.blodapels.in.')
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_populate_ptr_and_sshfp(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = [
+            {'type': 'PTR', 'name': '1.blodapels.in', 'ttl': 300,
+             'content': 'host.example.com', 'id': '1'},
+            {'type': 'SSHFP', 'name': 'host.blodapels.in', 'ttl': 300,
+             'content': '1 2 123456789abcdef', 'id': '2'}]
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   supports=['A', 'ptr', 'SSHFP'])
+        by_default = LexiconProvider(id="unittests",
+                                     lexicon_config=lexicon_config)
+        zone = Zone("blodapels.in.", [])
+        zone_by_default = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+        by_default.populate(zone_by_default)
+
+        # Then
+        self.assertEqual(provider.SUPPORTS, {'A', 'PTR', 'SSHFP'})
+        self.assertEqual(zone_by_default.records, set(),
+                         "PTR and SSHFP are opt-in")
+        records = {r._type: r for r in zone.records}
+        self.assertEqual(records['PTR'].value, 'host.example.com.')
+        self.assertEqual(records['SSHFP'].data['value'], {
+            'algorithm': 1, 'fingerprint_type': 2,
+            'fingerprint': '123456789abcdef'})
+        self.assertEqual(
+            [r.content for r in provider._rrset_for(records['SSHFP'])],
+            ['1 2 123456789abcdef'])
+        self.assertEqual(
+            [r.content for r in provider._rrset_for(records['PTR'])],
+            ['host.example.com.'])
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_populate_malformed_value(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = [
+            {'type': 'MX', 'name': 'blodapels.in', 'ttl': 300,
+             'content': 'mail.example.com.', 'id': '1'}]
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+
+        # Then
+        with self.assertRaises(ValueError):
+            provider.populate(Zone("blodapels.in.", []))
+
+    def test_split_content_as_shlex(self):
+        contents = [r['content'] for r in LEXICON_DATA] + [
+            '0 issue "letsencrypt.org; validationmethods=dns-01"',
+            '0 iodef "mailto:\\"hostmaster\\"@example.com"',
+            "0 issue 'single quoted' ''",
+            'a\\ b\\"c d"e f"\tg\n',
+            '"\\x"', '', '   ']
+
+        for content in contents:
+            self.assertEqual(split_content(content), shlex.split(content),
+                             content)
+        with self.assertRaises(ValueError):
+            split_content('0 issue "unterminated')
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_txt_values_escaped_and_chunked(self, mock_provider):
+        # Given
+        dkim = 'v=DKIM1; k=rsa; p=' + 'A' * 400
+        provider_mock = mock_provider.return_value
+        provider_mock.list_records.return_value = [
+            {'type': 'TXT', 'name': 'mail._domainkey.blodapels.in',
+             'ttl': 300, 'content': '"{}" "{}"'.format(dkim[:255], dkim[255:]),
+             'id': '1'},
+            {'type': 'TXT', 'name': 'mail._domainkey.blodapels.in',
+             'ttl': 300, 'content': 'say "hi"; bye', 'id': '2'}]
+        provider_mock.update_record.return_value = True
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+        existing = Zone("blodapels.in.", [])
+        provider.populate(existing)
+        txt = existing.records.pop()
+        desired = Record.new(existing, txt.name, {
+            'type': 'TXT', 'ttl': 600, 'values': txt.values})
+
+        # When
+        provider._apply(Plan(existing, existing, [Update(txt, desired)],
+                             True))
+
+        # Then
+        self.assertEqual(set(txt.values), {dkim.replace(';', '\\;'),
+                                           'say "hi"\\; bye'})
+        self.assertEqual(sorted(
+            c[1]['identifier'] + c[1]['content']
+            for c in provider_mock.update_record.call_args_list),
+            ['1"{}" "{}"'.format(dkim[:255], dkim[255:]),
+             '2say "hi"; bye'])
+
+    def test_txt_values_chunked_round_trip(self):
+        # Given
+        codec = TxtCodec()
+        value = 'a' * 254 + '"' + 'b\\; "c"' * 40
+        record = Record.new(ZONE, 'txt', {'type': 'TXT', 'ttl': 300,
+                                          'value': value})
+
+        # When
+        contents = codec.format(record)
+        parsed = codec.parse([{'content': c} for c in contents])
+
+        # Then
+        self.assertEqual(contents[0][:260], '"' + 'a' * 254 + '\\"" "')
+        self.assertEqual(record.values, [value])
+        self.assertEqual(parsed['values'], [value])
+
     def test_config_supports(self):
         provider_a = LexiconProvider(id="unittest",
                                      lexicon_config=lexicon_config,
@@ -233,6 +762,644 @@ class TestLexiconProvider(TestCase):
         self.assertEqual(config_resolver.resolve("lexicon:type"), "*")
         self.assertEqual(config_resolver.resolve("lexicon:missing"), None)
 
+    def test_config_resolver_ttl_overlay(self):
+        # Given
+        config_resolver = OnTheFlyLexiconConfigSource(domain="fiskppinne.")
+        seen_in_other_thread = []
+
+        # When
+        with config_resolver.ttl_overlay(300):
+            thread = Thread(target=lambda: seen_in_other_thread.append(
+                config_resolver.resolve("lexicon:ttl")))
+            thread.start()
+            thread.join()
+            ttl_inside = config_resolver.resolve("lexicon:ttl")
+
+        # Then
+        self.assertEqual(ttl_inside, 300)
+        self.assertEqual(seen_in_other_thread, [3600],
+                         "overlay is only visible to the calling thread")
+        self.assertEqual(config_resolver.resolve("lexicon:ttl"), 3600,
+                         "overlay is removed after the block")
+
+
+class TestZoneListingCache(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache_config = {
+            'directory': os.path.join(self.directory, 'listings')}
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_populate_from_cache(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = \
+            [dict(r) for r in LEXICON_DATA]
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   listing_cache=self.cache_config)
+        other_run = LexiconProvider(id="unittests",
+                                    lexicon_config=lexicon_config,
+                                    listing_cache=self.cache_config)
+        zone = Zone("blodapels.in.", [])
+        zone_from_cache = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+        exists = other_run.populate(zone_from_cache)
+
+        # Then
+        self.assertTrue(exists)
+        self.assertEqual(zone_from_cache.records, set(OCTODNS_DATA))
+        mock_provider.return_value.list_records.assert_called_once_with(
+            None, None, None)
+        self.assertEqual((provider.listing_cache.misses,
+                          other_run.listing_cache.hits), (1, 1))
+        mock_provider.return_value.authenticate.assert_called_once_with()
+        self.assertEqual(mock_provider.call_count, 1,
+                         "no client is created for a listing from cache")
+
+    @mock.patch('octodns_lexicon.time')
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_populate_expired(self, mock_provider, mock_time):
+        # Given
+        list_records = mock_provider.return_value.list_records
+        list_records.return_value = [dict(r) for r in LEXICON_DATA[:1]]
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   client_max_age=3600,
+                                   listing_cache=dict(self.cache_config,
+                                                      max_age=60))
+
+        # When
+        mock_time.return_value = 1000
+        provider.populate(Zone("blodapels.in.", []))
+        mock_time.return_value = 1059
+        provider.populate(Zone("blodapels.in.", []))
+        mock_time.return_value = 1060
+        provider.populate(Zone("blodapels.in.", []))
+
+        # Then
+        self.assertEqual(list_records.call_count, 2)
+        self.assertEqual((provider.listing_cache.hits,
+                          provider.listing_cache.misses), (1, 2))
+
+    @mock.patch('octodns_lexicon.time')
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_populate_stale_while_revalidate(self, mock_provider, mock_time):
+        # Given
+        list_records = mock_provider.return_value.list_records
+        list_records.return_value = [dict(r) for r in LEXICON_DATA[:1]]
+        provider = LexiconProvider(
+            id="unittests", lexicon_config=lexicon_config,
+            client_max_age=3600,
+            listing_cache=dict(self.cache_config, max_age=60,
+                               stale_while_revalidate=True))
+        stale_zone = Zone("blodapels.in.", [])
+
+        # When
+        mock_time.return_value = 1000
+        provider.populate(Zone("blodapels.in.", []))
+        list_records.return_value = [dict(r) for r in LEXICON_DATA[:2]]
+        mock_time.return_value = 1100
+        provider.populate(stale_zone)
+        provider.listing_cache.wait()
+        fresh_zone = Zone("blodapels.in.", [])
+        provider.populate(fresh_zone)
+
+        # Then
+        self.assertEqual(len(stale_zone.records), 1, "stale listing served")
+        self.assertEqual(len(fresh_zone.records), 2, "revalidated listing")
+        self.assertEqual(list_records.call_count, 2)
+        self.assertEqual((provider.listing_cache.hits,
+                          provider.listing_cache.stale_hits,
+                          provider.listing_cache.misses), (1, 1, 1))
+
+    def test_revalidation(self):
+        # Given
+        cache = ZoneListingCache('unittests', self.directory,
+                                 max_age=0, stale_while_revalidate=True)
+        cache.store('blodapels.in.', [])
+        listing_started, release_listing = Event(), Event()
+
+        def slow_failing_listing():
+            listing_started.set()
+            release_listing.wait()
+            raise RuntimeError('API unavailable')
+
+        # When
+        cache.get('blodapels.in.', slow_failing_listing)
+        listing_started.wait()
+        cache.get('blodapels.in.', slow_failing_listing)
+        release_listing.set()
+        cache.wait()
+
+        # Then
+        self.assertEqual(cache.stale_hits, 2)
+        self.assertEqual(cache.load('blodapels.in.')[0], [],
+                         "failed revalidation keeps the cached listing")
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_apply_lists_anew(self, mock_provider):
+        # Given
+        provider_mock = mock_provider.return_value
+        provider_mock.update_record.return_value = True
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   listing_cache=self.cache_config)
+        record = {'type': 'A', 'name': 'www.blodapels.in', 'ttl': 300,
+                  'content': '192.0.2.1'}
+        provider.listing_cache.store('blodapels.in.',
+                                     [dict(record, id='cached-id')])
+        provider_mock.list_records.return_value = \
+            [dict(record, id='fresh-id')]
+
+        existing = Zone("blodapels.in.", [])
+        provider.populate(existing)
+        www = existing.records.pop()
+        desired = Record.new(existing, 'www', {
+            'type': 'A', 'ttl': 300, 'values': ['192.0.2.2']})
+
+        # When
+        provider._apply(Plan(existing, existing, [Update(www, desired)],
+                             True))
+
+        # Then
+        provider_mock.list_records.assert_called_once_with(None, None, None)
+        provider_mock.update_record.assert_called_once_with(
+            identifier='fresh-id', content='192.0.2.2', rtype='A',
+            name='www.blodapels.in.')
+
+
+class TestApiMetrics(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_metrics_written_to_file(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = \
+            iter([dict(r) for r in LEXICON_DATA])
+        mock_provider.return_value.create_record.return_value = False
+        path = os.path.join(self.directory, 'lexicon.prom')
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   api_metrics={'file': path})
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+        with self.assertRaises(RecordCreateError):
+            provider._apply(Plan(zone, zone, [Create(OCTODNS_DATA[0])],
+                                 True))
+
+        # Then
+        with open(path) as fh:
+            lines = fh.read().splitlines()
+        labels = 'provider="unittests",zone="blodapels.in"'
+        self.assertIn('lexicon_api_calls_total{' + labels +
+                      ',operation="authenticate",outcome="success"} 1',
+                      lines)
+        self.assertIn('lexicon_api_calls_total{' + labels +
+                      ',operation="create_record",outcome="failure"} 1',
+                      lines)
+        self.assertIn('lexicon_api_call_seconds_count{' + labels +
+                      ',operation="list_records"} 1', lines)
+        self.assertIn('lexicon_listed_records_bucket{' + labels +
+                      ',le="10.0"} 0', lines)
+        self.assertIn('lexicon_listed_records_bucket{' + labels +
+                      ',le="100.0"} 1', lines)
+        self.assertIn('lexicon_listed_records_sum{' + labels + '} ' +
+                      str(len(LEXICON_DATA)), lines)
+        self.assertEqual(lines[-1], '# EOF')
+        self.assertIs(provider.api_metrics, LexiconProvider(
+            id="other", lexicon_config=lexicon_config,
+            api_metrics={'file': path}).api_metrics,
+            "providers exporting to the same file share their metrics")
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_metrics_served(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.side_effect = \
+            requests.ConnectionError('unreachable')
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   api_metrics={'port': 0})
+        url = 'http://127.0.0.1:{}'.format(
+            provider.api_metrics.server.server_address[1])
+        self.addCleanup(provider.api_metrics.stop)
+
+        # When
+        with self.assertRaises(requests.ConnectionError):
+            provider.populate(Zone("blodapels.in.", []))
+        scraped = requests.get(url + '/metrics')
+        not_found = requests.get(url + '/')
+
+        # Then
+        self.assertEqual(scraped.headers['Content-Type'],
+                         ApiMetrics.CONTENT_TYPE)
+        self.assertIn('lexicon_api_calls_total{provider="unittests",'
+                      'zone="blodapels.in",operation="list_records",'
+                      'outcome="error"} 1', scraped.text.splitlines())
+        self.assertEqual(not_found.status_code, 404)
+
+    def test_metered_provider(self):
+        # Given
+        api_metrics = ApiMetrics()
+        lexicon_provider = Mock()
+        lexicon_provider.delete_record.side_effect = ValueError('gone')
+        metered = MeteredProvider(lexicon_provider, api_metrics, 'unittests',
+                                  'blodapels.in')
+
+        # When
+        metered.update_record('1', 'A', 'www', '10.0.0.1')
+        metered.replace_rrset(rtype='A', name='www', contents=[])
+        with self.assertRaises(ValueError):
+            metered.delete_record('1')
+
+        # Then
+        lexicon_provider.update_record.assert_called_once_with(
+            '1', 'A', 'www', '10.0.0.1')
+        lexicon_provider.replace_rrset.assert_called_once_with(
+            rtype='A', name='www', contents=[])
+        self.assertEqual(
+            {(dict(labels)['operation'], dict(labels)['outcome']): n
+             for labels, n in api_metrics.calls.items()},
+            {('update_record', 'success'): 1,
+             ('replace_rrset', 'success'): 1,
+             ('delete_record', 'error'): 1})
+
+    def test_label_values_escaped(self):
+        # Given
+        api_metrics = ApiMetrics()
+
+        # When
+        api_metrics.observe_call((('zone', 'a"b\\c\nd'),), 'authenticate',
+                                 'success', 0.1)
+
+        # Then
+        self.assertIn('lexicon_api_calls_total{zone="a\\"b\\\\c\\nd",'
+                      'operation="authenticate",outcome="success"} 1',
+                      api_metrics.render())
+
+
+class TestZoneProfiler(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_deterministic_profile(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = \
+            [dict(r) for r in LEXICON_DATA]
+        mock_provider.return_value.create_record.return_value = True
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   profile={'directory': self.directory,
+                                            'top': 3})
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        provider.populate(zone)
+        provider._apply(Plan(zone, zone, [Create(OCTODNS_DATA[0])], True))
+        with mock.patch.object(provider.profiler.log, 'info') as info:
+            provider.profiler.report()
+
+        # Then
+        self.assertEqual(zone.records, set(OCTODNS_DATA))
+        self.assertEqual(sorted(os.listdir(self.directory)), [
+            'unittests-blodapels.in.apply.pstats',
+            'unittests-blodapels.in.populate.pstats'])
+        stats = pstats.Stats(os.path.join(
+            self.directory, 'unittests-blodapels.in.populate.pstats'))
+        self.assertIn('_load_records', {name for _, _, name in stats.stats})
+        self.assertEqual(provider.profiler.profiled, 2)
+        self.assertEqual(info.call_count, 4, "a header and 3 hotspots")
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_overlapping_operations_run_unprofiled(self, mock_provider):
+        # Given
+        mock_provider.return_value.list_records.return_value = \
+            [dict(r) for r in LEXICON_DATA]
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   profile={'directory': self.directory})
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        with provider.profiler.tracing:
+            with mock.patch.object(provider.profiler.log, 'debug') as debug:
+                provider.populate(zone)
+
+        # Then
+        self.assertEqual(zone.records, set(OCTODNS_DATA))
+        self.assertEqual(os.listdir(self.directory), [])
+        self.assertEqual(provider.profiler.profiled, 0)
+        self.assertIn('another operation is being profiled',
+                      debug.call_args[0][0])
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_sampling_profile(self, mock_provider):
+        # Given
+        def slow_listing(*args):
+            sleep(0.05)
+            return [dict(r) for r in LEXICON_DATA]
+
+        mock_provider.return_value.list_records.side_effect = slow_listing
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   profile={'directory': self.directory,
+                                            'mode': 'sampling',
+                                            'interval': 0.001})
+
+        # When
+        provider.populate(Zone("blodapels.in.", []))
+        with mock.patch.object(provider.profiler.log, 'info') as info:
+            provider.profiler.report()
+
+        # Then
+        self.assertIn('samples  slow_listing', '\n'.join(
+            args[0] % args[1:] for args, _ in info.call_args_list))
+        with open(os.path.join(
+                self.directory,
+                'unittests-blodapels.in.populate.collapsed')) as fh:
+            stacks = [line.rsplit(' ', 1) for line in fh]
+        self.assertTrue(any('profiled_populate' in stack and
+                            stack.split(';')[-1].startswith('slow_listing')
+                            for stack, _ in stacks))
+        hotspots = dict(provider.profiler.hotspots())
+        slow = [f for f in hotspots if f.startswith('slow_listing')]
+        self.assertEqual(len(slow), 1, hotspots)
+        self.assertGreater(hotspots[slow[0]], 10)
+
+    def test_nothing_profiled(self):
+        # Given
+        directory = os.path.join(self.directory, 'profiles')
+        profiler = ZoneProfiler('unittests', directory)
+
+        # When
+        profiler.report()
+
+        # Then
+        self.assertTrue(os.path.isdir(directory))
+        self.assertEqual(profiler.hotspots(), [])
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            LexiconProvider(id="unittests", lexicon_config=lexicon_config,
+                            profile={'directory': self.directory,
+                                     'mode': 'statistical'})
+
+    def test_off_by_default(self):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+
+        # Then
+        self.assertIsNone(provider.profiler)
+        self.assertNotIn('populate', vars(provider))
+        self.assertNotIn('_apply', vars(provider))
+
+
+class TestZoneIdIndex(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.index_config = {'directory': os.path.join(directory, 'ids')}
+        self.record = {'type': 'A', 'name': 'www.blodapels.in', 'ttl': 300,
+                       'content': '192.0.2.1', 'id': 'listed-id'}
+
+    def _plan(self, planner, values):
+        existing = Zone("blodapels.in.", [])
+        planner.populate(existing)
+        www = next(iter(existing.records))
+        desired = Record.new(existing, 'www', {
+            'type': 'A', 'ttl': 300, 'values': values})
+        return Plan(existing, existing, [Update(www, desired)], True)
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_apply_in_other_process(self, mock_provider):
+        # Given
+        provider_mock = mock_provider.return_value
+        provider_mock.list_records.return_value = [dict(self.record)]
+        provider_mock.update_record.return_value = True
+        planner = LexiconProvider(id="unittests",
+                                  lexicon_config=lexicon_config,
+                                  id_index=self.index_config)
+        applier = LexiconProvider(id="unittests",
+                                  lexicon_config=lexicon_config,
+                                  id_index=self.index_config)
+        plan = self._plan(planner, ['192.0.2.2'])
+
+        # When
+        applier._apply(plan)
+
+        # Then
+        provider_mock.list_records.assert_called_once_with(None, None, None)
+        provider_mock.update_record.assert_called_once_with(
+            identifier='listed-id', content='192.0.2.2', rtype='A',
+            name='www.blodapels.in.')
+        self.assertEqual(applier.id_index.hits, 1)
+        self.assertIsNone(
+            applier.id_index.load('blodapels.in.', plan.existing.records),
+            "ids are discarded once the zone has changed")
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_apply_lists_anew_when_zone_changed(self, mock_provider):
+        # Given
+        provider_mock = mock_provider.return_value
+        provider_mock.list_records.return_value = [dict(self.record)]
+        provider_mock.update_record.return_value = True
+        planner = LexiconProvider(id="unittests",
+                                  lexicon_config=lexicon_config,
+                                  id_index=self.index_config)
+        applier = LexiconProvider(id="unittests",
+                                  lexicon_config=lexicon_config,
+                                  id_index=self.index_config)
+        plan = self._plan(planner, ['192.0.2.3'])
+        # Zone changed between planning and applying
+        provider_mock.list_records.return_value = [
+            dict(self.record, content='192.0.2.2', id='changed-id')]
+        planner.populate(Zone("blodapels.in.", []))
+        provider_mock.list_records.return_value = [
+            dict(self.record, id='fresh-id')]
+
+        # When
+        applier._apply(plan)
+
+        # Then
+        self.assertEqual(provider_mock.list_records.call_count, 3)
+        provider_mock.update_record.assert_called_once_with(
+            identifier='fresh-id', content='192.0.2.3', rtype='A',
+            name='www.blodapels.in.')
+        self.assertEqual(applier.id_index.misses, 1)
+
+
+class TestStandInDNSAPI(TestCase):
+
+    def setUp(self):
+        self.records = [{'type': 'A', 'name': 'host{}'.format(i),
+                         'data': '192.0.2.{}'.format(i + 1)}
+                        for i in range(25)]
+
+    def _serve(self, **kwargs):
+        server = StandInDNSAPI('example.com', self.records, **kwargs).start()
+        self.addCleanup(server.stop)
+        return server
+
+    def test_populate_paginated_with_latency(self):
+        # Given
+        server = self._serve(per_page=10, latency=0.01, jitter=0.005)
+        provider = StandInLexiconProvider('unittests', server.url)
+        zone = Zone('example.com.', [])
+
+        # When
+        provider.populate(zone)
+
+        # Then
+        self.assertEqual(len(zone.records), 25)
+        self.assertEqual(server.requests_by_endpoint,
+                         {'GET domain': 1, 'GET records': 3})
+        self.assertGreaterEqual(server.latency_added, 4 * 0.005)
+
+    def test_apply_retries_throttled_requests(self):
+        # Given
+        server = self._serve(throttle_every=3, retry_after=0)
+        provider = StandInLexiconProvider(
+            'unittests', server.url, rate_limit={'rate': 1000, 'backoff': 0})
+        existing = Zone('example.com.', [])
+        provider.populate(existing)
+        desired = Zone('example.com.', [])
+        for record in existing.records:
+            desired.add_record(Record.new(desired, record.name, {
+                'type': 'A', 'ttl': 600, 'values': record.values}))
+
+        # When
+        provider.apply(provider.plan(desired))
+
+        # Then
+        self.assertGreater(server.throttled, 0)
+        self.assertEqual({r['ttl'] for r in server.records.values()}, {600})
+
+
+def http_error(status_code, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    return requests.HTTPError(response=response)
+
+
+@mock.patch('octodns_lexicon.sleep')
+@mock.patch('octodns_lexicon.time', return_value=1000)
+class TestRateLimiter(TestCase):
+
+    def test_burst_then_rate(self, mock_time, mock_sleep):
+        # Given
+        limiter = RateLimiter(rate=2, burst=3)
+
+        # When
+        for _ in range(5):
+            limiter.acquire()
+
+        # Then
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(0.5), mock.call(1.0)],
+                         "burst goes through, then queue up at rate")
+
+        # When
+        mock_sleep.reset_mock()
+        mock_time.return_value = 1002.5
+        limiter.acquire()
+
+        # Then
+        mock_sleep.assert_not_called()
+
+    @mock.patch('octodns_lexicon.random.uniform', side_effect=lambda a, b: b)
+    def test_backoff_when_throttled(self, _, mock_time, mock_sleep):
+        # Given
+        limiter = RateLimiter(rate=8, burst=100, backoff=1, max_backoff=3)
+        func = Mock(side_effect=[http_error(429), http_error(429),
+                                 http_error(503, {'Retry-After': '2.5'}),
+                                 http_error(429), 'listed'])
+
+        # When
+        result = limiter.call(func, 'A', name='www')
+
+        # Then
+        self.assertEqual(result, 'listed')
+        self.assertEqual(func.call_args_list, [mock.call('A', name='www')] * 5)
+        self.assertEqual(mock_sleep.call_args_list,
+                         [mock.call(1), mock.call(2), mock.call(3),
+                          mock.call(3)],
+                         "exponential backoff, capped by max_backoff")
+        self.assertEqual(limiter.throttled, 4)
+        self.assertEqual(limiter.rate, 0.5 + 0.4,
+                         "rate halved when throttled, raised on success")
+
+    @mock.patch('octodns_lexicon.random.uniform', return_value=0.1)
+    def test_retry_after(self, _, mock_time, mock_sleep):
+        # Given
+        limiter = RateLimiter(rate=8, burst=100)
+        func = Mock(side_effect=[http_error(429, {'Retry-After': '4'}), True])
+
+        # When
+        limiter.call(func)
+
+        # Then
+        mock_sleep.assert_called_once_with(4.0)
+
+    def test_gives_up(self, mock_time, mock_sleep):
+        # Given
+        limiter = RateLimiter(rate=8, burst=100, max_retries=2)
+        throttled = Mock(side_effect=http_error(429))
+        failing = Mock(side_effect=http_error(500))
+
+        # Then
+        with self.assertRaises(requests.HTTPError):
+            limiter.call(throttled)
+        self.assertEqual(throttled.call_count, 3)
+
+        with self.assertRaises(requests.HTTPError):
+            limiter.call(failing)
+        self.assertEqual(failing.call_count, 1, "only throttling is retried")
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_provider_calls_are_rate_limited(self, mock_provider, *_):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   rate_limit={'rate': 5})
+        lexicon_provider = mock_provider.return_value
+        lexicon_provider.list_records.return_value = []
+        for method in ('create_record', 'update_record', 'delete_record'):
+            getattr(lexicon_provider, method).return_value = True
+
+        # When
+        lexicon_client, _ = provider.clients.get('blodapels.in')
+        provider.populate(Zone("blodapels.in.", []))
+        lexicon_client.provider.create_record(rtype='A', name='a',
+                                              content='192.0.2.1')
+        lexicon_client.provider.update_record(identifier='1', rtype='A',
+                                              name='a', content='192.0.2.2')
+        lexicon_client.provider.delete_record(identifier='1')
+
+        # Then
+        self.assertIsInstance(lexicon_client.provider, RateLimitedProvider)
+        self.assertIs(lexicon_client.provider.domain_id,
+                      lexicon_provider.domain_id)
+        self.assertEqual(len(lexicon_provider.method_calls), 5)
+        self.assertEqual(provider.rate_limiter.tokens, 0)
+
 
 class TestLexiconProviderApplyScenarios(TestCase):
 
@@ -436,10 +1603,12 @@ class TestLexiconProviderApplyScenarios(TestCase):
                       name='test-many.blodapels.in.')]
 
         expected_calls_for_delete = [
-            mock.call(content='192.168.2.3',
+            mock.call(identifier=None,
+                      content='192.168.2.3',
                       rtype='A',
                       name='test-many.blodapels.in.'),
-            mock.call(content='192.168.2.4',
+            mock.call(identifier=None,
+                      content='192.168.2.4',
                       rtype='A',
                       name='test-many.blodapels.in.')]
 
@@ -519,7 +1688,7 @@ class TestLexiconProviderApplyScenarios(TestCase):
                                                ['92.0.3.0', '192.0.2.1']},
                                           source=source)
         lexicon_records = [r.to_list_format() for r in
-                           self.provider._rrset_for_A(
+                           self.provider._rrset_for(
                                record_to_update_existing)]
         for r in lexicon_records:
             r.update({'id': 'X'})
@@ -615,3 +1784,424 @@ class TestLexiconProviderApplyScenarios(TestCase):
         # Then
         with self.assertRaises(RecordDeleteError):
             self.provider._apply(plan)
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_apply_concurrently(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   apply_max_workers=4)
+        provider_mock.return_value = self.provider_mock
+
+        cname_to_delete = Record.new(ZONE, 'replaced',
+                                     {'ttl': 30, 'type': 'CNAME', 'value':
+                                         'www.example.com.'},
+                                     source=source)
+        a_to_create = Record.new(ZONE, 'replaced',
+                                 {'ttl': 30, 'type': 'A', 'values':
+                                     ['192.0.2.1']},
+                                 source=source)
+        changeset = [Delete(cname_to_delete), Create(a_to_create)]
+        changeset += [Create(r) for r in OCTODNS_DATA]
+
+        plan = Plan(ZONE, ZONE, changeset, True)
+
+        # When
+        provider._apply(plan)
+
+        # Then
+        self.assertEqual(self.provider_mock.create_record.call_count, 14)
+        self.provider_mock.authenticate.assert_called_once_with()
+        calls_for_name = [c for c in self.provider_mock.method_calls
+                          if c[2].get('name') == 'replaced.blodapels.in.']
+        planned_for_name = ['delete_record'
+                            if isinstance(c, Delete) else 'create_record'
+                            for c in plan.changes
+                            if c.record.name == 'replaced']
+        self.assertEqual([c[0] for c in calls_for_name], planned_for_name,
+                         "changes to the same name are applied in order")
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_apply_concurrently_collects_errors(self, provider_mock):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   apply_max_workers=4)
+        provider_mock.return_value = self.provider_mock
+
+        def create_record(rtype, name, content):
+            return rtype != 'SRV'
+
+        self.provider_mock.create_record.side_effect = create_record
+        plan = Plan(ZONE, ZONE, [Create(r) for r in OCTODNS_DATA], True)
+
+        # When
+        with self.assertRaises(ApplyErrors) as ctx:
+            provider._apply(plan)
+
+        # Then
+        self.assertEqual(len(ctx.exception.errors), 5,
+                         "every failed name is reported")
+        for error in ctx.exception.errors:
+            self.assertIsInstance(error, RecordCreateError)
+        self.assertEqual(self.provider_mock.create_record.call_count, 13,
+                         "a failure does not stop other names")
+
+
+class TestRRSetUpdate(TestCase):
+
+    def setUp(self):
+        self.existing = Record.new(ZONE, '@', {
+            'ttl': 10800, 'type': 'MX', 'values': [
+                {'priority': '10', 'exchange': 'spool.mail.example.com.'},
+                {'priority': '50', 'exchange': 'fb.mail.example.com.'}]})
+        self.desired = Record.new(ZONE, '@', {
+            'ttl': 3600, 'type': 'MX', 'values': [
+                {'priority': '10', 'exchange': 'spool.mail.example.com.'},
+                {'priority': '20', 'exchange': 'mx2.mail.example.com.'},
+                {'priority': '50', 'exchange': 'fb.mail.example.com.'}]})
+        self.cname = Record.new(ZONE, 'www', {
+            'ttl': 300, 'type': 'CNAME', 'value': 'webredir.example.com.'})
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_one_call_per_rrset(self, mock_provider):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   rrset_update=True)
+        lexicon_provider = mock_provider.return_value
+        lexicon_provider.replace_rrset.return_value = True
+        plan = Plan(ZONE, ZONE, [Update(self.existing, self.desired),
+                                 Delete(self.cname),
+                                 Update(self.cname, self.cname)], True)
+
+        # When
+        provider._apply(plan)
+
+        # Then
+        self.assertEqual(lexicon_provider.replace_rrset.call_args_list, [
+            mock.call(rtype='MX', name='@.blodapels.in.',
+                      contents=['10 spool.mail.example.com.',
+                                '20 mx2.mail.example.com.',
+                                '50 fb.mail.example.com.']),
+            mock.call(rtype='CNAME', name='www.blodapels.in.', contents=[])])
+        lexicon_provider.create_record.assert_not_called()
+        lexicon_provider.delete_record.assert_not_called()
+        lexicon_provider.update_record.assert_not_called()
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_replace_fails(self, mock_provider):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   rrset_update=True)
+        mock_provider.return_value.replace_rrset.return_value = False
+
+        # Then
+        with self.assertRaises(RecordUpdateError):
+            provider._apply(Plan(ZONE, ZONE, [Delete(self.cname)], True))
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def test_fall_back_to_value_by_value(self, mock_provider):
+        # Given
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config,
+                                   rrset_update=True,
+                                   rate_limit={'rate': 100})
+        mock_provider.return_value = Mock(spec=[
+            'authenticate', 'list_records', 'create_record',
+            'update_record', 'delete_record'])
+        lexicon_provider = mock_provider.return_value
+        lexicon_provider.create_record.return_value = True
+
+        # When
+        with mock.patch.object(provider.log, 'warning') as warning:
+            provider._apply(Plan(ZONE, ZONE, [Create(self.desired)], True))
+
+        # Then
+        self.assertEqual(warning.call_args[0][0],
+                         'rrset_update: not supported by %s, '
+                         'updating value by value')
+        self.assertEqual(lexicon_provider.create_record.call_count, 3)
+
+    def test_powerdns_pooled(self):
+        # Given
+        pdns_config = {
+            'provider_name': 'powerdns',
+            'powerdns': {'pdns_server': 'http://pdns.example.com',
+                         'auth_token': 'X'}}
+        provider = LexiconProvider(id="unittests", lexicon_config=pdns_config,
+                                   rrset_update=True, http_pool_size=2)
+        zone_url = 'http://pdns.example.com/api/v1/servers/localhost/' \
+                   'zones/blodapels.in.'
+        zone = Zone("blodapels.in.", [])
+        desired = Record.new(zone, 'www', {'type': 'CNAME', 'ttl': 300,
+                                           'value': 'www.example.com.'})
+
+        # When
+        with requests_mock.Mocker() as m, \
+                mock.patch.object(provider.http_sessions, 'request',
+                                  wraps=provider.http_sessions.request) \
+                as pooled_request:
+            m.get(zone_url, json={'kind': 'Native', 'rrsets': []})
+            m.patch(zone_url, status_code=204)
+            lexicon_client, _ = provider.clients.get('blodapels.in')
+            self.addCleanup(POOLED_REQUESTS.uninstall,
+                            lexicon_client.provider)
+            provider.populate(zone)
+            provider._apply(Plan(zone, zone, [Create(desired)], True))
+
+        # Then
+        powerdns_module = sys.modules['lexicon.providers.powerdns']
+        self.assertIs(powerdns_module.requests, POOLED_REQUESTS)
+        self.assertIs(octodns_lexicon.requests, requests,
+                      "not installed in the module of the rrset adapter")
+        self.assertIsInstance(lexicon_client.provider, PooledProvider)
+        self.assertEqual([c[0][0] for c in pooled_request.call_args_list],
+                         [r.method for r in m.request_history])
+        self.assertEqual(m.request_history[-1].method, 'PATCH')
+
+    def test_powerdns(self):
+        # Given
+        pdns_config = {
+            'provider_name': 'powerdns',
+            'powerdns': {'pdns_server': 'http://pdns.example.com',
+                         'auth_token': 'X'}}
+        provider = LexiconProvider(id="unittests", lexicon_config=pdns_config,
+                                   rrset_update=True,
+                                   rate_limit={'rate': 100})
+        zone_url = 'http://pdns.example.com/api/v1/servers/localhost/' \
+                   'zones/blodapels.in.'
+        zone_data = {'kind': 'Native', 'rrsets': [
+            {'name': 'blodapels.in.', 'type': 'MX', 'ttl': 10800,
+             'records': [
+                 {'content': '10 spool.mail.example.com.', 'disabled': False},
+                 {'content': '50 fb.mail.example.com.', 'disabled': False}]},
+            {'name': 'www.blodapels.in.', 'type': 'CNAME', 'ttl': 300,
+             'records': [
+                 {'content': 'webredir.example.com.', 'disabled': False}]}]}
+        zone = Zone("blodapels.in.", [])
+
+        # When
+        with requests_mock.Mocker() as m:
+            m.get(zone_url, json=zone_data)
+            m.patch(zone_url, status_code=204)
+            provider.populate(zone)
+            existing = {r.name: r for r in zone.records}
+            desired = Record.new(zone, '', dict(self.desired.data,
+                                                type='MX'))
+            provider._apply(Plan(zone, zone, [
+                Update(existing[''], desired),
+                Delete(existing['www'])], True))
+
+        # Then
+        patches = [r.json() for r in m.request_history if r.method == 'PATCH']
+        mx_records = [
+            {'content': '10 spool.mail.example.com.', 'disabled': False},
+            {'content': '20 mx2.mail.example.com.', 'disabled': False},
+            {'content': '50 fb.mail.example.com.', 'disabled': False}]
+        self.assertEqual(patches, [
+            {'rrsets': [{'name': 'blodapels.in.', 'type': 'MX', 'ttl': 3600,
+                         'changetype': 'REPLACE', 'records': mx_records}]},
+            {'rrsets': [{'name': 'www.blodapels.in.', 'type': 'CNAME',
+                         'ttl': 300, 'changetype': 'DELETE',
+                         'records': []}]}])
+        lexicon_client, _ = provider.clients.get('blodapels.in')
+        self.assertIsInstance(lexicon_client.provider.wrapped,
+                              PowerDNSRRSets)
+
+
+class TestValueMatching(TestCase):
+    """Counts the lexicon calls made for typical edits of an rrset"""
+
+    @mock.patch('lexicon.providers.gandi.Provider')
+    def apply_edit(self, ids_by_value, values, ttl, mock_provider):
+        provider = LexiconProvider(id="unittests",
+                                   lexicon_config=lexicon_config)
+        lexicon_provider = mock_provider.return_value
+        lexicon_provider.list_records.return_value = [
+            {'type': 'A', 'name': 'www.blodapels.in', 'ttl': 300,
+             'content': value, 'id': _id}
+            for value, _id in sorted(ids_by_value.items())]
+        for method in ('create_record', 'update_record', 'delete_record'):
+            getattr(lexicon_provider, method).return_value = True
+
+        existing = Zone("blodapels.in.", [])
+        provider.populate(existing)
+        desired = Record.new(existing, 'www', {'type': 'A', 'ttl': ttl,
+                                               'values': values})
+        provider._apply(Plan(existing, existing,
+                             [Update(existing.records.pop(), desired)], True))
+
+        self.apply_stats = provider.apply_stats
+        return lexicon_provider.method_calls[2:]
+
+    def assertCalls(self, calls, update=0, create=0, delete=0):
+        made = [c[0] for c in calls]
+        self.assertEqual((made.count('update_record'),
+                          made.count('create_record'),
+                          made.count('delete_record')),
+                         (update, create, delete))
+
+    def test_ttl_change(self):
+        calls = self.apply_edit(
+            {'192.0.2.1': '1', '192.0.2.2': '2', '192.0.2.3': '3'},
+            ['192.0.2.1', '192.0.2.2', '192.0.2.3'], 600)
+
+        self.assertCalls(calls, update=3)
+        self.assertEqual(
+            {(c[2]['identifier'], c[2]['content']) for c in calls},
+            {('1', '192.0.2.1'), ('2', '192.0.2.2'), ('3', '192.0.2.3')},
+            "values keep their identifier")
+
+    def test_replace_value(self):
+        calls = self.apply_edit(
+            {'192.0.2.1': '1', '192.0.2.2': '2', '192.0.2.3': '3'},
+            ['192.0.2.1', '192.0.2.4', '192.0.2.3'], 300)
+
+        self.assertCalls(calls, update=1)
+
+    def test_shrink_and_grow(self):
+        calls = self.apply_edit(
+            {'192.0.2.1': '1', '192.0.2.2': '2', '192.0.2.3': '3'},
+            ['192.0.2.1', '192.0.2.4', '192.0.2.5', '192.0.2.6'], 300)
+
+        self.assertCalls(calls, update=2, create=1)
+
+        calls = self.apply_edit(
+            {'192.0.2.1': '1', '192.0.2.2': '2', '192.0.2.3': '3'},
+            ['192.0.2.4'], 300)
+
+        self.assertCalls(calls, update=1, delete=2)
+        self.assertEqual(sorted(c[2]['identifier'] for c in calls
+                                if c[0] == 'delete_record'), ['2', '3'],
+                         "deletes are made by identifier")
+        self.assertEqual(self.apply_stats['deletes_by_content'], 0)
+
+    def test_partly_shared_ids(self):
+        # Updating by the shared id 'www' would be ambiguous, but the values
+        # with their own id can still be updated in place. Previously this
+        # was 2 creates and 2 deletes.
+        calls = self.apply_edit(
+            {'192.0.2.1': '1', '192.0.2.2': '2',
+             '192.0.2.3': 'www', '192.0.2.4': 'www'},
+            ['192.0.2.5', '192.0.2.6', '192.0.2.3', '192.0.2.4'], 300)
+
+        self.assertCalls(calls, update=2)
+
+        calls = self.apply_edit(
+            {'192.0.2.1': '1', '192.0.2.2': '2',
+             '192.0.2.3': 'www', '192.0.2.4': 'www'},
+            ['192.0.2.1', '192.0.2.2', '192.0.2.5'], 300)
+
+        self.assertCalls(calls, create=1, delete=2)
+        self.assertEqual([c[2]['identifier'] for c in calls
+                          if c[0] == 'delete_record'], [None, None],
+                         "shared ids are not used to delete")
+        self.assertEqual((self.apply_stats['deletes'],
+                          self.apply_stats['deletes_by_content']), (2, 2))
+
+    def test_ttl_change_with_shared_ids(self):
+        calls = self.apply_edit({'192.0.2.1': 'www', '192.0.2.2': 'www'},
+                                ['192.0.2.1', '192.0.2.2', '192.0.2.3'], 600)
+
+        self.assertCalls(calls, create=3, delete=2)
+        self.assertEqual([c[0] for c in calls],
+                         ['delete_record'] * 2 + ['create_record'] * 3,
+                         "values re-created with new TTL are deleted first")
+
+
+class TestMemoizedListings(TestCase):
+
+    def test_snapshot(self):
+        # Given
+        lexicon_provider = Mock()
+        lexicon_provider._full_name.side_effect = \
+            lambda name: name.rstrip('.')
+        lexicon_provider._get_lexicon_option.return_value = 600
+        lexicon_provider._list_records.return_value = [
+            {'type': 'A', 'name': 'www.blodapels.in', 'ttl': 300,
+             'content': '192.0.2.1', 'id': '1'},
+            {'type': 'A', 'name': 'www.blodapels.in', 'ttl': 300,
+             'content': '192.0.2.2', 'id': '2'},
+            {'type': 'TXT', 'name': 'www.blodapels.in', 'ttl': 300,
+             'content': 'hello', 'id': '3'}]
+        list_records = lexicon_provider._list_records
+        memoized = MemoizedListings(RateLimitedProvider(lexicon_provider,
+                                                        RateLimiter(100)))
+
+        # When
+        memoized.install()
+        www = lexicon_provider._list_records('A', 'WWW.blodapels.in.')
+        created = memoized.create_record(rtype='A', name='www.blodapels.in.',
+                                         content='192.0.2.3')
+        memoized.update_record(identifier='1', rtype='A',
+                               name='www.blodapels.in.', content='192.0.2.9')
+        memoized.delete_record(identifier='2', rtype='A',
+                               name='www.blodapels.in.', content='192.0.2.2')
+        memoized.delete_record(rtype='TXT', name='www.blodapels.in.',
+                               content='hello')
+        remaining = lexicon_provider._list_records()
+        memoized.uninstall()
+
+        # Then
+        self.assertTrue(created)
+        self.assertEqual((memoized.listed, memoized.served), (1, 1))
+        list_records.assert_called_once_with(None, None, None)
+        self.assertEqual(len(www), 2, "zone listed when first needed")
+        self.assertEqual(remaining, [
+            {'type': 'A', 'name': 'www.blodapels.in', 'ttl': 600,
+             'content': '192.0.2.9', 'id': '1'},
+            {'type': 'A', 'name': 'www.blodapels.in', 'ttl': 600,
+             'content': '192.0.2.3', 'id': None}])
+        self.assertIs(lexicon_provider._list_records, list_records,
+                      "provider restored")
+
+    def test_apply(self):
+        # Given
+        do_config = {'provider_name': 'digitalocean',
+                     'digitalocean': {'auth_token': 'X'}}
+        api = 'https://api.digitalocean.com/v2/domains/blodapels.in'
+        records = {'domain_records': [
+            {'id': 1, 'type': 'CNAME', 'name': 'old', 'ttl': 300,
+             'data': 'www.example.com.'},
+            {'id': 2, 'type': 'A', 'name': 'upd', 'ttl': 300,
+             'data': '192.0.2.1'}], 'links': {}}
+        www = Record.new(ZONE, 'www', {'ttl': 300, 'type': 'A', 'values': [
+            '192.0.2.10', '192.0.2.11', '192.0.2.12']})
+        gone = Record.new(ZONE, 'gone', {'ttl': 300, 'type': 'CNAME',
+                                         'value': 'www.example.com.'})
+        upd = Record.new(ZONE, 'upd', {'ttl': 300, 'type': 'A',
+                                       'values': ['192.0.2.9']})
+
+        def apply(memoize_listings):
+            provider = LexiconProvider(id="unittests",
+                                       lexicon_config=do_config,
+                                       memoize_listings=memoize_listings)
+            zone = Zone("blodapels.in.", [])
+            with requests_mock.Mocker() as m:
+                m.get(api, json={'domain': {}})
+                m.get(api + '/records', json=records)
+                m.post(api + '/records', status_code=201, json={})
+                m.put(api + '/records/2', json={})
+                m.delete(api + '/records/1', status_code=204)
+                provider.populate(zone)
+                existing = {r.name: r for r in zone.records}
+                m.reset_mock()
+                provider._apply(Plan(zone, zone, [
+                    Create(www), Delete(existing['old']), Delete(gone),
+                    Update(existing['upd'], upd)], True))
+
+            return [r.method for r in m.request_history]
+
+        # When
+        requests_made = apply(memoize_listings=False)
+        requests_made_memoized = apply(memoize_listings=True)
+
+        # Then
+        self.assertEqual(requests_made.count('GET'), 4,
+                         "lexicon lists for every create and content delete")
+        self.assertEqual(requests_made_memoized.count('GET'), 1)
+        self.assertEqual(
+            [m for m in requests_made_memoized if m != 'GET'],
+            [m for m in requests_made if m != 'GET'])